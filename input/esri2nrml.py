@@ -18,14 +18,21 @@ Simple LandScan ESRI binary file to NRML converter
 for exposure population models. 
 """
 
-import struct
 import ConfigParser
 import argparse
 import sys
 import math
 import datetime
+import gzip
+import multiprocessing
+import os
+import numpy
 from lxml import etree
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "nrml_utils"))
+from nrml_utils.writer import INDENT, ASSET_LEVEL, serialize_fragment
+
 
 NRML_NS = "http://openquake.org/xmlns/nrml/0.3"
 GML_NS = "http://www.opengis.net/gml"
@@ -33,20 +40,35 @@ NSMAP = {None: NRML_NS, "gml": GML_NS}
 NRML = "{%s}" % NRML_NS
 GML = "{%s}" % GML_NS
 
+# byte orders accepted in the [data] section of the metadata
+BYTE_ORDERS = {"lsb": "<", "msb": ">"}
+
+ASSET_TAG = "assetDefinition"
+
+
+def read_binary_data(filename, dtype="<i2"):
+    """
+    Map the binary raster as a flat array of cells of the given
+    type. Cells are read from disk only when they are accessed.
+    """
+    return numpy.memmap(filename, dtype=dtype, mode="r")
 
-def read_binary_data(filename):
-    results = []
 
-    with open(filename, "rb") as data:
-        # at the moment, we only support two bytes
-        # integer format.
-        bytes_read = data.read(2)
-        while bytes_read:
-            # at the moment, we only support LSB format.
-            results.append(struct.unpack("<h", bytes_read)[0])
-            bytes_read = data.read(2)
+def get_data_type(config):
+    """
+    Return the type of the raster cells, as given by the optional
+    datatype (numpy type, e.g. i2, i4, f4) and byteorder (lsb or msb)
+    options of the [data] section. Defaults to two bytes LSB integers.
+    """
+    datatype = "i2"
+    byteorder = "lsb"
 
-    return results
+    if config.has_option("data", "datatype"):
+        datatype = config.get("data", "datatype")
+    if config.has_option("data", "byteorder"):
+        byteorder = config.get("data", "byteorder").lower()
+
+    return numpy.dtype(datatype).newbyteorder(BYTE_ORDERS[byteorder])
 
 
 def read_metadata(filename):
@@ -72,10 +94,34 @@ def cmd_parser():
         dest="taxonomy", nargs="?", required=True,
         help="assets taxonomy")
 
+    args_parser.add_argument("-s", "--skip-empty",
+        dest="skip_empty", action="store_true", default=False,
+        help="do not write assets for nodata and zero valued cells")
+
+    args_parser.add_argument("-p", "--processes",
+        dest="processes", type=int, default=1,
+        help="number of processes serializing the raster tiles")
+
+    args_parser.add_argument("-r", "--tile-rows",
+        dest="tile_rows", type=int, default=10,
+        help="number of raster rows in each tile (with --processes)")
+
+    args_parser.add_argument("-o", "--output",
+        dest="output", default="exp_model.xml",
+        help="output file (default: exp_model.xml)")
+
+    args_parser.add_argument("-z", "--gzip",
+        dest="gzip", action="store_true", default=False,
+        help="gzip compress the output file")
+
     return args_parser
 
 
-def asset_iterator(config, data):
+def get_grid(config):
+    """
+    Return the number of rows and columns of the raster, and
+    the coordinates of the centres of its columns and rows.
+    """
     nrows = config.getint("georeference", "nrows")
     ncols = config.getint("georeference", "ncols")
 
@@ -84,79 +130,220 @@ def asset_iterator(config, data):
     xmax = config.getfloat("georeference", "xmax") 
     ymax = config.getfloat("georeference", "ymax") 
 
-    no_data = config.getfloat("data", "nodatavalue") 
-
     x_step = math.fabs((xmax - xmin) / ncols)
     y_step = math.fabs((ymax - ymin) / nrows)
 
+    # cell centres, computed once for all the rows and columns.
+    lons = xmin + (numpy.arange(ncols) + 0.5) * x_step
+    lats = ymax - (numpy.arange(nrows) + 0.5) * y_step
+
+    assert xmin <= lons.min() and lons.max() <= xmax
+    assert ymin <= lats.min() and lats.max() <= ymax
+
+    return nrows, ncols, lons, lats
+
+
+def asset_iterator(config, data, skip_empty=False, rows=None):
+    """
+    Yield (lon, lat, value) for the cells of the raster, row by row.
+    Nodata cells have value 0 and, when skip_empty is set, cells with
+    no positive value are not yielded at all. rows is an optional
+    (start, stop) range of the rows to iterate.
+    """
+    nrows, ncols, lons, lats = get_grid(config)
+    no_data = config.getfloat("data", "nodatavalue") 
+
     assert nrows * ncols == len(data)
 
-    current_x = xmin + (x_step / 2)
-    current_y = ymax - (y_step / 2)
+    start, stop = rows if rows is not None else (0, nrows)
+    cells = data.reshape(nrows, ncols)
 
-    for counter, value in enumerate(data, start=1):
-        assert xmin <= current_x <= xmax
-        assert ymin <= current_y <= ymax
-        
-        yield (current_x, current_y,
-            value if value != no_data else 0)
+    for row in xrange(start, stop):
+        values = numpy.where(cells[row] != no_data, cells[row], 0)
+        row_lons = lons
 
-        current_x = current_x + x_step
+        if skip_empty:
+            populated = values > 0
+            row_lons, values = lons[populated], values[populated]
 
-        # we are on the last column.
-        if counter % ncols == 0:
-            current_x = xmin + (x_step / 2)
-            current_y = current_y - y_step
+        lat = float(lats[row])
+        for lon, value in zip(row_lons.tolist(), values.tolist()):
+            yield (lon, lat, value)
 
 
-class ExposureModelWriter(object):
+def count_assets(config, data, rows, skip_empty):
+    """
+    Return the number of assets asset_iterator yields for the
+    given range of rows.
+    """
+    ncols = config.getint("georeference", "ncols")
+    no_data = config.getfloat("data", "nodatavalue")
+    start, stop = rows
+
+    if not skip_empty:
+        return (stop - start) * ncols
+
+    cells = data[start * ncols:stop * ncols]
+    return int(numpy.count_nonzero((cells != no_data) & (cells > 0)))
+
+
+def tile_tasks(args, config, data):
+    """
+    Split the raster in tiles of rows, and yield the arguments of
+    serialize_tile for each of them. The id of the first asset of
+    each tile follows from the number of assets in the previous ones.
+    """
+    nrows = config.getint("georeference", "nrows")
+    first_id = 1
 
-    def __init__(self, taxonomy):
+    for start in xrange(0, nrows, args.tile_rows):
+        rows = (start, min(start + args.tile_rows, nrows))
+        yield (args.mdata, args.data, args.taxonomy,
+            args.skip_empty, rows, first_id)
+        first_id += count_assets(config, data, rows, args.skip_empty)
+
+
+def serialize_tile(task):
+    """
+    Serialize the assets of a tile of rows to a fragment of XML.
+    Run by the worker processes, which map the raster on their own.
+    """
+    mdata, data, taxonomy, skip_empty, rows, first_id = task
+
+    config = read_metadata(mdata)
+    bdata = read_binary_data(data, get_data_type(config))
+
+    return assets_fragment(taxonomy,
+        asset_iterator(config, bdata, skip_empty, rows), first_id)
+
+
+def asset_element(asset_id, asset_data, taxonomy):
+    asset = etree.Element(ASSET_TAG, nsmap=NSMAP)
+    asset.set("%sid" % GML, "asset_" + str(asset_id))
+
+    site = etree.SubElement(asset, "site")
+    point = etree.SubElement(site, "%sPoint" % GML)
+    point.set("srsName", "epsg:4326")
+    pos = etree.SubElement(point, "%spos" % GML)
+    pos.text = " ".join([str(asset_data[0]), str(asset_data[1])])
+
+    number = etree.SubElement(asset, "number")
+    number.text = str(asset_data[2] if asset_data[2] >= 0 else 0)
+
+    taxonomy_elem = etree.SubElement(asset, "taxonomy")
+    taxonomy_elem.text = taxonomy
+
+    return asset
+
+
+def assets_fragment(taxonomy, assets, first_id):
+    """
+    Serialize the assets to assetDefinition elements, with ids
+    starting from first_id and indented as in the complete document.
+    """
+    separator = "\n" + INDENT * ASSET_LEVEL
+
+    return separator.join(
+        serialize_fragment(asset_element(asset_id, asset_data, taxonomy),
+            ASSET_LEVEL)
+        for asset_id, asset_data in enumerate(assets, start=first_id))
+
+
+class ExposureModelWriter(object):
+    """
+    Write the exposure model while assets are added. The output can
+    be a file name or a file object, optionally gzip compressed. Only
+    the last buffer_size assets added are kept in memory.
+    """
+
+    def __init__(self, taxonomy, output="exp_model.xml", compress=False,
+            buffer_size=1000):
         self.counter = 1
         self.taxonomy = taxonomy
+        self.buffer_size = buffer_size
+        self.pending = []
         
         # <nrml /> element
-        self.root = etree.Element("nrml", nsmap=NSMAP)
-        self.root.set("%sid" % GML, "n1")
+        root = etree.Element("nrml", nsmap=NSMAP)
+        root.set("%sid" % GML, "n1")
 
-        exp_model = etree.SubElement(self.root, "exposureModel")
+        exp_model = etree.SubElement(root, "exposureModel")
         exp_model.set("%sid" % GML, "em1")
 
         etree.SubElement(exp_model, "config")
 
         # <exposureList /> element
-        self.exposure_list = etree.SubElement(exp_model, "exposureList")
-        self.exposure_list.set("%sid" % GML, "el1")
-        self.exposure_list.set("assetCategory", "population")
+        exposure_list = etree.SubElement(exp_model, "exposureList")
+        exposure_list.set("%sid" % GML, "el1")
+        exposure_list.set("assetCategory", "population")
+
+        etree.SubElement(exposure_list, "%sdescription" % GML)
+        etree.SubElement(exposure_list, "taxonomySource")
+
+        text = etree.tostring(
+                root, pretty_print=True,
+                xml_declaration=True,
+                encoding="UTF-8")
+
+        # the assets go before the line closing the exposure list.
+        closing = text.rindex("</exposureList>")
+        end = text.rindex("\n", 0, closing)
+        self.separator = text[end:closing] + INDENT
+        self.tail = text[end:]
 
-        etree.SubElement(self.exposure_list, "%sdescription" % GML)
-        etree.SubElement(self.exposure_list, "taxonomySource")
+        self.owns_output = not hasattr(output, "write")
+
+        if self.owns_output:
+            output = open(output, "wb")
+
+        self.fh = gzip.GzipFile(fileobj=output, mode="wb") \
+            if compress else output
+
+        # GzipFile does not close the file object it wraps.
+        self.output = output
+        self.fh.write(text[:end])
 
     def add(self, asset_data):
-        asset = etree.SubElement(self.exposure_list, "assetDefinition")
-        asset.set("%sid" % GML, "asset_" + str(self.counter))
+        self.pending.append(asset_data)
 
-        site = etree.SubElement(asset, "site")
-        point = etree.SubElement(site, "%sPoint" % GML)
-        point.set("srsName", "epsg:4326")
-        pos = etree.SubElement(point, "%spos" % GML)
-        pos.text = " ".join([str(asset_data[0]), str(asset_data[1])])
+        if len(self.pending) >= self.buffer_size:
+            self._flush()
 
-        number = etree.SubElement(asset, "number")
-        number.text = str(asset_data[2] if asset_data[2] >= 0 else 0)
+    def add_fragment(self, fragment):
+        """
+        Write a fragment returned by assets_fragment after the
+        assets added so far.
+        """
+        self._flush()
 
-        taxonomy = etree.SubElement(asset, "taxonomy")
-        taxonomy.text = self.taxonomy
+        if fragment:
+            self.fh.write(self.separator)
+            self.fh.write(fragment)
 
-        self.counter += 1
+    def _flush(self):
+        if self.pending:
+            self.fh.write(self.separator)
+            self.fh.write(assets_fragment(
+                self.taxonomy, self.pending, self.counter))
 
-    def serialize(self):
-        with open("exp_model.xml", "w") as fh:
+            self.counter += len(self.pending)
+            self.pending = []
 
-            fh.write(etree.tostring(
-                    self.root, pretty_print=True,
-                    xml_declaration=True,
-                    encoding="UTF-8"))
+    def serialize(self, fragments=()):
+        """
+        Write fragments, as returned by assets_fragment, and the end
+        of the document. Close the output if the writer opened it.
+        """
+        for fragment in fragments:
+            self.add_fragment(fragment)
+
+        self._flush()
+        self.fh.write(self.tail)
+
+        if self.fh is not self.output:
+            self.fh.close()
+        if self.owns_output:
+            self.output.close()
 
 
 if __name__ == "__main__":
@@ -173,14 +360,21 @@ if __name__ == "__main__":
     print ">> Started at: " + str(started_at)
 
     metadata = read_metadata(args.mdata)
-    bdata = read_binary_data(args.data)
+    bdata = read_binary_data(args.data, get_data_type(metadata))
 
-    writer = ExposureModelWriter(args.taxonomy)
+    writer = ExposureModelWriter(args.taxonomy, args.output, args.gzip)
 
-    for asset_data in asset_iterator(metadata, bdata):
-        writer.add(asset_data)
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        writer.serialize(pool.imap(serialize_tile,
+            tile_tasks(args, metadata, bdata)))
+        pool.close()
+        pool.join()
+    else:
+        for asset_data in asset_iterator(metadata, bdata, args.skip_empty):
+            writer.add(asset_data)
 
-    writer.serialize()
+        writer.serialize()
 
     elapsed_time = (datetime.datetime.now() - started_at)
     print ">> Time spent: %ss, %sms" % (
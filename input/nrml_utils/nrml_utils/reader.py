@@ -13,7 +13,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with NRML.  If not, see <http://www.gnu.org/licenses/>.
 
-from csv import DictReader
+from collections import namedtuple
+from csv import DictReader, reader as csv_reader
+
+NO_VALUE = ''
 
 
 class ExposureTxtReader(object):
@@ -51,6 +54,59 @@ class ExposureTxtReader(object):
         reader = DictReader(self.txtfile, fieldnames=self.ASSETS_FIELDNAMES)
         return [asset for asset in reader]
 
+    def iterassets(self):
+        """
+        Yield the assets one at a time as ExposureAsset records.
+        lon and lat are floats, the other numeric fields are ints or
+        floats (None when missing) and taxonomy is a string. The text
+        field holds the values as they were read, which writers
+        serialize unchanged (e.g. 0.050 or 3.2e4). Rows missing one
+        of the compulsory fields raise a RuntimeError.
+        """
+        self._move_to_assets_definitions()
+        nfields = len(self.ASSETS_FIELDNAMES)
+        for row in csv_reader(self.txtfile):
+            if not row:
+                continue
+            row = [value.strip() for value in row]
+            row.extend([NO_VALUE] * (nfields - len(row)))
+            yield self._parse_asset(row[:nfields])
+
+    def _parse_asset(self, row):
+        lon, lat, taxonomy = row[0], row[1], row[2]
+        if lon == NO_VALUE or lat == NO_VALUE:
+            raise RuntimeError('lon and lat are compulsory values for an '
+                               'asset: %s' % ','.join(row))
+        if taxonomy == NO_VALUE:
+            raise RuntimeError('taxonomy is a compulsory value for an '
+                               'asset: %s' % ','.join(row))
+        try:
+            return ExposureAsset(float(lon), float(lat), taxonomy,
+                *[_parse_number(value) for value in row[3:]],
+                text=tuple(row))
+        except ValueError:
+            raise RuntimeError('invalid numeric value for an asset: %s'
+                               % ','.join(row))
+
+
+ExposureAsset = namedtuple('ExposureAsset',
+                           ExposureTxtReader.ASSETS_FIELDNAMES + ['text'])
+# records built from values only are serialized from the values, and
+# so must be records changed with _replace, by setting text to None.
+ExposureAsset.__new__.__defaults__ = (None,)
+
+
+def _parse_number(value):
+    """
+    Parse value to an int or a float, None when missing.
+    """
+    if value == NO_VALUE:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
 
 class VulnerabilityTxtReader(object):
 
@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with NRML.  If not, see <http://www.gnu.org/licenses/>.
 
+from io import BytesIO
 from lxml import etree
 
 NRML_NS = 'http://openquake.org/xmlns/nrml/0.3'
@@ -42,7 +43,8 @@ DESCRIPTION =  '%sdescription' % GML
 TAXONOMY_SOURCE = '%staxonomySource' % NRML
 
 # Asset definition tagnames
-ASSET = "%sassetDefinition" % NRML
+ASSET_TAGNAME = 'assetDefinition'
+ASSET = "%s%s" % (NRML, ASSET_TAGNAME)
 SITE = "%ssite" % NRML
 GML_POINT = "%sPoint" % GML
 GML_SRS_ATTR_NAME = 'srsName'
@@ -78,16 +80,69 @@ PROB_DISTR = 'probabilisticDistribution'
 
 NO_VALUE = ''
 
+# indentation of pretty printed documents, and nesting level of
+# the assetDefinition elements (nrml/exposureModel/exposureList)
+INDENT = '  '
+ASSET_LEVEL = 3
+
+
+def serialize_fragment(element, level):
+    """
+    Pretty print element as it is printed in a document, nested at
+    the given level, whose root declares the namespaces of element.
+    The element must be created with the nsmap of the root, so that
+    it uses the same prefixes, and its text values must not span
+    multiple lines. The first line is not indented.
+    """
+    empty = etree.tostring(etree.Element(element.tag, nsmap=element.nsmap))
+    name_end = empty.find(' ')
+    declarations = empty[name_end:-2] if name_end > 0 else ''
+
+    text = etree.tostring(element, encoding='utf-8', xml_declaration=False,
+        pretty_print=True)
+    text = text.replace(declarations, '', 1).rstrip('\n')
+    return text.replace('\n', '\n' + INDENT * level)
+
 
 class ExposureWriter(object):
 
     def serialize(self, filename, metadata, assets):
+        """
+        Write the exposure model to filename. Assets are consumed
+        one at a time from the given iterable and each assetDefinition
+        is written as soon as it is built, so memory does not grow with
+        the number of assets. The output is identical to the pretty
+        printed document of the whole tree.
+        """
         root_elem = self._write_header(metadata)
-        root_elem = self._write_assets(root_elem, assets)
-        tree = etree.ElementTree(root_elem)
+        assets = iter(assets)
+        first_asset = next(assets, None)
         with open(filename, 'w') as output_file:
-            tree.write(output_file, xml_declaration=True,
-                encoding='utf-8', pretty_print=True)
+            if first_asset is None:
+                self._write_tree(output_file, root_elem)
+                return
+
+            # the assets take the place of a comment closing the list.
+            marker = etree.Comment(ASSET_TAGNAME)
+            root_elem.find('.//%s' % EXPOSURE_LIST).append(marker)
+            document = BytesIO()
+            self._write_tree(document, root_elem)
+            head, tail = document.getvalue().split(etree.tostring(marker))
+            separator = '\n' + head[head.rindex('\n') + 1:]
+
+            output_file.write(head)
+            output_file.write(serialize_fragment(
+                self._write_asset(1, first_asset), ASSET_LEVEL))
+            for i, asset in enumerate(assets, start=2):
+                output_file.write(separator)
+                output_file.write(serialize_fragment(
+                    self._write_asset(i, asset), ASSET_LEVEL))
+            output_file.write(tail)
+
+    def _write_tree(self, output_file, root_elem):
+        tree = etree.ElementTree(root_elem)
+        tree.write(output_file, xml_declaration=True,
+            encoding='utf-8', pretty_print=True)
 
     def _value_defined_for(self, dict, attrib):
         return dict[attrib] != NO_VALUE
@@ -135,84 +190,109 @@ class ExposureWriter(object):
             taxonomy_source.text = metadata['taxonomySource']
         return root_elem
 
-    def _write_assets(self, root_elem, assets):
-        exp_list = root_elem.find('.//%s' % EXPOSURE_LIST)
-        for i, asset in enumerate(assets, start=1):
-            asset_elem = etree.SubElement(
-                exp_list, ASSET)
-            asset_elem.attrib[GML_ID] = 'asset_%s' % i
-
-            if (self._value_defined_for(asset, 'lon') and
-                self._value_defined_for(asset, 'lat')):
-
-                site_elem = etree.SubElement(
-                    asset_elem, SITE)
-                point_elem = etree.SubElement(
-                    site_elem, GML_POINT)
-                point_elem.attrib[GML_SRS_ATTR_NAME] = GML_SRS_EPSG_4326
-                pos_elem = etree.SubElement(
-                    point_elem, GML_POS)
-                pos_elem.text = " ".join([asset['lon'], asset['lat']])
-            else:
-               raise RuntimeError('lon and lat are compulsory values for an '
-                                  'asset')
-
-            if self._value_defined_for(asset, 'area'):
-                area_elem = etree.SubElement(
-                    asset_elem, AREA)
-                area_elem.text = asset['area']
-
-            if self._value_defined_for(asset, 'coco'):
-                coco_elem = etree.SubElement(
-                    asset_elem, COCO)
-                coco_elem.text = asset['coco']
-
-            if self._value_defined_for(asset, 'deductible'):
-                deduct_elem = etree.SubElement(
-                    asset_elem, DEDUCTIBLE)
-                deduct_elem.text = asset['deductible']
-
-            if self._value_defined_for(asset, 'limit'):
-                limit_elem = etree.SubElement(
-                    asset_elem, LIMIT)
-                limit_elem.text = asset['limit']
-
-            if self._value_defined_for(asset, 'number'):
-                number_elem = etree.SubElement(
-                    asset_elem, NUMBER)
-                number_elem.text = asset['number']
-
-            if self._value_defined_for(asset, 'occupantDay'):
-                occupants_elem = etree.SubElement(
-                    asset_elem, OCCUPANTS)
-                occupants_elem.text = asset['occupantDay']
-                occupants_elem.attrib['description'] = 'day'
-
-            if self._value_defined_for(asset, 'occupantNight'):
-                occupants_elem = etree.SubElement(
-                    asset_elem, OCCUPANTS)
-                occupants_elem.text = asset['occupantNight']
-                occupants_elem.attrib['description'] = 'night'
-
-            if self._value_defined_for(asset, 'reco'):
-                reco_elem = etree.SubElement(
-                    asset_elem, RECO)
-                reco_elem.text = asset['reco']
-
-            if self._value_defined_for(asset, 'stco'):
-                stco_elem = etree.SubElement(
-                    asset_elem, STCO)
-                stco_elem.text = asset['stco']
-
-            if self._value_defined_for(asset, 'taxonomy'):
-                taxonomy_elem = etree.SubElement(
-                    asset_elem, TAXONOMY)
-                taxonomy_elem.text = asset['taxonomy']
-            else:
-                raise RuntimeError('taxonomy is a compulsory value for '
-                                   'an asset')
-
-        return root_elem
+    def _asset_values(self, asset):
+        """
+        Return the text of each field of an asset. Assets can be
+        dictionaries of strings or ExposureAsset records, written with
+        the text they were read from or, when it is None, with their
+        values, where None marks a missing value.
+        """
+        if isinstance(asset, dict):
+            return asset
+        if asset.text is not None:
+            return dict(zip(asset._fields, asset.text))
+        return dict((field, _value_text(value))
+                    for field, value in zip(asset._fields, asset))
+
+    def _write_asset(self, i, asset):
+        asset = self._asset_values(asset)
+        asset_elem = etree.Element(ASSET, nsmap=NSMAP)
+        asset_elem.attrib[GML_ID] = 'asset_%s' % i
+
+        if (self._value_defined_for(asset, 'lon') and
+            self._value_defined_for(asset, 'lat')):
+
+            site_elem = etree.SubElement(
+                asset_elem, SITE)
+            point_elem = etree.SubElement(
+                site_elem, GML_POINT)
+            point_elem.attrib[GML_SRS_ATTR_NAME] = GML_SRS_EPSG_4326
+            pos_elem = etree.SubElement(
+                point_elem, GML_POS)
+            pos_elem.text = " ".join([asset['lon'], asset['lat']])
+        else:
+            raise RuntimeError('lon and lat are compulsory values for an '
+                               'asset')
+
+        if self._value_defined_for(asset, 'area'):
+            area_elem = etree.SubElement(
+                asset_elem, AREA)
+            area_elem.text = asset['area']
+
+        if self._value_defined_for(asset, 'coco'):
+            coco_elem = etree.SubElement(
+                asset_elem, COCO)
+            coco_elem.text = asset['coco']
+
+        if self._value_defined_for(asset, 'deductible'):
+            deduct_elem = etree.SubElement(
+                asset_elem, DEDUCTIBLE)
+            deduct_elem.text = asset['deductible']
+
+        if self._value_defined_for(asset, 'limit'):
+            limit_elem = etree.SubElement(
+                asset_elem, LIMIT)
+            limit_elem.text = asset['limit']
+
+        if self._value_defined_for(asset, 'number'):
+            number_elem = etree.SubElement(
+                asset_elem, NUMBER)
+            number_elem.text = asset['number']
+
+        if self._value_defined_for(asset, 'occupantDay'):
+            occupants_elem = etree.SubElement(
+                asset_elem, OCCUPANTS)
+            occupants_elem.text = asset['occupantDay']
+            occupants_elem.attrib['description'] = 'day'
+
+        if self._value_defined_for(asset, 'occupantNight'):
+            occupants_elem = etree.SubElement(
+                asset_elem, OCCUPANTS)
+            occupants_elem.text = asset['occupantNight']
+            occupants_elem.attrib['description'] = 'night'
+
+        if self._value_defined_for(asset, 'reco'):
+            reco_elem = etree.SubElement(
+                asset_elem, RECO)
+            reco_elem.text = asset['reco']
+
+        if self._value_defined_for(asset, 'stco'):
+            stco_elem = etree.SubElement(
+                asset_elem, STCO)
+            stco_elem.text = asset['stco']
+
+        if self._value_defined_for(asset, 'taxonomy'):
+            taxonomy_elem = etree.SubElement(
+                asset_elem, TAXONOMY)
+            taxonomy_elem.text = asset['taxonomy']
+        else:
+            raise RuntimeError('taxonomy is a compulsory value for '
+                               'an asset')
+
+        return asset_elem
+
+
+def _value_text(value):
+    """
+    Return the text of a field value, with floats formatted by repr.
+    """
+    if value is None:
+        return NO_VALUE
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, basestring):
+        return value
+    return str(value)
 
 
 class VulnerabilityWriter(object):
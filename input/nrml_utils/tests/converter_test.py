@@ -17,8 +17,9 @@ import unittest
 import os
 from lxml import etree
 from StringIO import StringIO
+from io import BytesIO
 
-from nrml_utils.reader import ExposureTxtReader
+from nrml_utils.reader import ExposureTxtReader, ExposureAsset
 from nrml_utils.writer import ExposureWriter
 
 NRML_SCHEMA_FILE = os.path.abspath('../nrml_utils/schema/nrml.xsd')
@@ -73,6 +74,29 @@ class AnExposureTxtReaderShould(unittest.TestCase):
         expected_assets = [first_asset, second_asset]
         self.assertEqual(expected_assets, self.exp_reader.readassets())
 
+    def test_iterate_assets(self):
+        first_asset = ExposureAsset(28.6925, 40.9775, 'RC_MR_LC', 40000, 50,
+                                    1500, 4000, 1000, 10, None, 0.05, 32000,
+                                    ('28.6925', '40.9775', 'RC_MR_LC',
+                                     '40000', '50', '1500', '4000', '1000',
+                                     '10', '', '0.05', '32000'))
+        second_asset = ExposureAsset(28.6975, 40.9825, 'RC_MR_LC', 300000,
+                                     100, 1000, 30000, 2000, 15, None, 0.10,
+                                     240000,
+                                     ('28.6975', '40.9825', 'RC_MR_LC',
+                                      '300000', '100', '1000', '30000',
+                                      '2000', '15', '', '0.10', '240000'))
+
+        assets = self.exp_reader.iterassets()
+        self.assertEqual(first_asset, next(assets))
+        self.assertEqual([second_asset], list(assets))
+
+    def test_reject_assets_without_compulsory_values(self):
+        self.content.seek(0, os.SEEK_END)
+        self.content.write('\n28.7025,40.9875,,1000,1,,,,,,,')
+
+        self.assertRaises(RuntimeError, list, self.exp_reader.iterassets())
+
 
 class AnExposureWriterShould(unittest.TestCase):
 
@@ -117,3 +141,62 @@ class AnExposureWriterShould(unittest.TestCase):
         self.assertTrue(validates_against_xml_schema(self.output_filename,
             NRML_SCHEMA_FILE))
 
+
+    def test_serialize_assets_from_reader(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               'data/example_exposure.txt')) as input_file:
+            reader = ExposureTxtReader(input_file)
+            self.writer.serialize(self.output_filename, reader.metadata,
+                reader.iterassets())
+
+        self.assertTrue(validates_against_xml_schema(self.output_filename,
+            NRML_SCHEMA_FILE))
+
+    def test_serialize_numbers_as_read(self):
+        content = StringIO('expModId,assetCategory,description,stcoType,'
+                           'stcoUnit,areaType,areaUnit,cocoType,'
+                           'cocoUnit,recoType,recoUnit,taxonomySource\n'
+                           'PAV01,buildings,bla bla bla,aggregated,USD,'
+                           'per_asset,GBP,per_area,CHF,aggregated,'
+                           'EUR,pavia taxonomy\n\n'
+                           'lon,lat,taxonomy,stco,number,area,reco,coco,'
+                           'occupantDay,occupantNight,deductible,limit\n'
+                           '28.69250,40.97750,RC_MR_LC,3.2e4,50,1500,4000,'
+                           '1000,10,,0.050,32000')
+        self.writer.serialize(self.output_filename,
+            ExposureTxtReader(content).metadata,
+            ExposureTxtReader(content).iterassets())
+
+        asset = etree.parse(self.output_filename).find(
+            '//{http://openquake.org/xmlns/nrml/0.3}assetDefinition')
+        values = [element.text for element in asset.iter()
+                  if element.text is not None and element.text.strip()]
+        self.assertTrue('28.69250 40.97750' in values)
+        self.assertTrue('3.2e4' in values)
+        self.assertTrue('0.050' in values)
+
+    def test_serialize_values_of_records_without_text(self):
+        asset = ExposureAsset(28.6925, 40.9775, 'RC_MR_LC', 40000, 50, 1500,
+                              4000, 1000, 10, None, 0.5 / 10, 32000)
+        self.writer.serialize(self.output_filename, self.metadata, [asset])
+
+        asset = etree.parse(self.output_filename).find(
+            '//{http://openquake.org/xmlns/nrml/0.3}assetDefinition')
+        values = [element.text for element in asset.iter()
+                  if element.text is not None and element.text.strip()]
+        self.assertTrue('28.6925 40.9775' in values)
+        self.assertTrue('0.05' in values)
+        self.assertTrue('32000' in values)
+
+    def test_serialize_as_the_whole_tree_would(self):
+        self.writer.serialize(self.output_filename, self.metadata,
+            (asset for asset in
+                [self.first_asset, self.second_asset, self.third_asset]))
+
+        parser = etree.XMLParser(remove_blank_text=True)
+        expected = BytesIO()
+        etree.parse(self.output_filename, parser).write(expected,
+            xml_declaration=True, encoding='utf-8', pretty_print=True)
+
+        with open(self.output_filename) as output_file:
+            self.assertEqual(expected.getvalue(), output_file.read())
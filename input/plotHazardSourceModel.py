@@ -4,67 +4,76 @@
 """
 
 import os
-import re
 import sys
 import os.path
 import numpy as np
-from xml.dom import minidom
+from lxml import etree
 from optparse import OptionParser
 from subprocess import call
 
-TMP_FILE = "./tmp.tmp"
+# geometries are matched in any namespace, posLists in the GML one
+AREA_BOUNDARY = "{*}areaBoundary"
+SIMPLE_FAULT_GEOMETRY = "{*}simpleFaultGeometry"
+POS_LIST = "{http://www.opengis.net/gml}posList"
 
-def get_coordinates_simple_fault_sources(xmldoc):
-    coordinates_list = []
-    fault_dat = xmldoc.getElementsByTagName('simpleFaultGeometry')
-    for node in fault_dat:
-        pos_list = node.getElementsByTagName('gml:posList')
-        for pos in pos_list:
-            coordinates = []
-            for v in pos.firstChild.data.split():
-                coordinates.append(float(v))
-            coordinates_list.append(coordinates)
-    return coordinates_list
-
-def get_coordinates_area_sources(xmldoc):
-    coordinates_list = []
-    area_dat = xmldoc.getElementsByTagName('areaBoundary')
-    for node in area_dat:
-        pos_list = node.getElementsByTagName('gml:posList')
-        for pos in pos_list:
-            coordinates = []
-            for v in pos.firstChild.data.split():
-                coordinates.append(float(v))
-            coordinates_list.append(coordinates)
-    return coordinates_list
-
-def create_ascii_file_area_sources(coordinates_list,file_name):
-    ascii_file_name = file_name+"_area_sources.dat"
-    ascii_file = open(ascii_file_name,'w')
-    for i in range(0,len(coordinates_list)):
-        aa = coordinates_list[i]
-        ascii_file.write(">\n")
-        for j in range(0,len(aa),2):
-            ascii_file.write("%s %s\n" % (aa[j],aa[j+1]))
-    ascii_file.write(">\n")
-    ascii_file.close()
-    if len(coordinates_list) == 0:
-        ascii_file_name = None
-    return ascii_file_name
+def iter_source_geometries(source_model_file):
+    """
+    Yields the tag and the coordinates (as a 2D array, one row
+    per point) of each posList in the areaBoundary and
+    simpleFaultGeometry elements of a nrml file. Elements are
+    freed as soon as they are used, so memory does not grow
+    with the size of the file.
+    """
+    for _, element in etree.iterparse(source_model_file,
+            tag=(AREA_BOUNDARY, SIMPLE_FAULT_GEOMETRY)):
+        # area boundaries are lon lat pairs, fault traces
+        # lon lat depth triples
+        if element.tag.endswith("}areaBoundary"):
+            tag, n_columns = AREA_BOUNDARY, 2
+        else:
+            tag, n_columns = SIMPLE_FAULT_GEOMETRY, 3
+        for pos in element.iter(POS_LIST):
+            yield tag, np.fromstring(pos.text, dtype=float,
+                    sep=" ").reshape(-1, n_columns)
+        # free this element and the ones parsed before it
+        element.clear()
+        while element.getparent() is not None:
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+            element = parent
 
-def create_ascii_file_simple_fault_sources(coordinates_list,file_name):
-    ascii_file_name = file_name+"_simple_fault_sources.dat"
-    ascii_file = open(ascii_file_name,'w')
-    for i in range(0,len(coordinates_list)):
-        aa = coordinates_list[i]
+def create_ascii_files(source_model_file,file_name):
+    """
+    Writes the GMT multi-segment files of area sources and simple
+    fault sources while streaming the nrml file. Returns the names
+    of the files (None when there are no such sources) and the
+    min and max values of longitude and latitude
+    """
+    file_names = {AREA_BOUNDARY: file_name+"_area_sources.dat",
+            SIMPLE_FAULT_GEOMETRY: file_name+"_simple_fault_sources.dat"}
+    ascii_files = dict((tag, open(name,'w'))
+            for tag, name in file_names.items())
+    counts = dict.fromkeys(file_names, 0)
+    min_lon = min_lat = +1e20
+    max_lon = max_lat = -1e20
+    for tag, coordinates in iter_source_geometries(source_model_file):
+        ascii_files[tag].write(">\n")
+        np.savetxt(ascii_files[tag], coordinates, fmt="%s")
+        counts[tag] += 1
+        # Updating min and max values of longitude and latitude
+        if len(coordinates) > 0:
+            min_lon = min(min_lon, coordinates[:,0].min())
+            max_lon = max(max_lon, coordinates[:,0].max())
+            min_lat = min(min_lat, coordinates[:,1].min())
+            max_lat = max(max_lat, coordinates[:,1].max())
+    for tag, ascii_file in ascii_files.items():
         ascii_file.write(">\n")
-        for j in range(0,len(aa),3):
-            ascii_file.write("%s %s %s\n" % (aa[j],aa[j+1],aa[j+2]))
-    ascii_file.write(">\n")
-    ascii_file.close()
-    if len(coordinates_list) == 0:
-        ascii_file_name = None
-    return ascii_file_name
+        ascii_file.close()
+        if counts[tag] == 0:
+            file_names[tag] = None
+    return (file_names[AREA_BOUNDARY], file_names[SIMPLE_FAULT_GEOMETRY],
+            (min_lon, max_lon, min_lat, max_lat))
 
 def set_gmt_parameters():
     cmd = "gmtset MAP_FRAME_TYPE plain"; os.system(cmd) 
@@ -103,31 +112,6 @@ def create_gmt_plot(file_area_sources,file_simple_fault_sources,region_str,
             " -Wthin -N1 -A1000 -O >> " + postscript_file
     os.system(cmd) 
 
-def get_min_max_lon_lat(xy_file_list):
-    """
-    Computes the min and max values of longitude and latitude
-    """
-    min_lon = +1e20
-    max_lon = -1e20
-    min_lat = +1e20
-    max_lat = -1e20
-    # Processing the xy files
-    for file_xy in xy_file_list:
-        if file_xy is not None:
-            cmd = "minmax -C " + file_xy + " > " + TMP_FILE  
-            os.system(cmd) 
-            f = open(TMP_FILE,'r') 
-            line = f.readline() 
-            min_max_list = re.split("\s+",line)
-            # Updating min and max values of longitude and latitude 
-            min_lon = np.amin(np.array([min_lon,float(min_max_list[0])]))
-            max_lon = np.amax(np.array([max_lon,float(min_max_list[1])]))
-            min_lat = np.amin(np.array([min_lat,float(min_max_list[2])]))
-            max_lat = np.amax(np.array([max_lat,float(min_max_list[3])]))
-    # Create the region string 
-    region_str = "-R%.2f/%.2f/%.2f/%.2f" % (min_lon, max_lon, min_lat, max_lat)
-    return region_str, min_lon, max_lon, min_lat, max_lat
-
 def main(argv):
     usage = "usage: python %prog [options]"
     epilog = "The usage of this script is conditional on the acceptance"+\
@@ -164,22 +148,17 @@ def main(argv):
     (options, args) = parser.parse_args()
     # Fix orientation and projection page width
     output_file_name = options.output_file_name
-    # Parse nrml file
-    xmldoc = minidom.parse(options.file_name_seismic_source_model)
-    # Retrieving files
-    file_area_sources = create_ascii_file_area_sources(
-            get_coordinates_area_sources(xmldoc),output_file_name)
-    file_simple_fault_sources = create_ascii_file_simple_fault_sources(
-            get_coordinates_simple_fault_sources(xmldoc),output_file_name)
+    # Parse nrml file, retrieving files
+    file_area_sources, file_simple_fault_sources, min_max = \
+            create_ascii_files(options.file_name_seismic_source_model,
+                    output_file_name)
 
     if options.map_region:
         region_str = "-R"+options.map_region
     else:
-         min_max_str = get_min_max_lon_lat([
-                file_area_sources, file_simple_fault_sources])
-         print "min lon: %.2f max lon: %.2f" % (min_max_str[1],min_max_str[2])
-         print "min lat: %.2f max lat: %.2f" % (min_max_str[3],min_max_str[4])
-         region_str = min_max_str[0] 
+         print "min lon: %.2f max lon: %.2f" % (min_max[0],min_max[1])
+         print "min lat: %.2f max lat: %.2f" % (min_max[2],min_max[3])
+         region_str = "-R%.2f/%.2f/%.2f/%.2f" % min_max
     # Fix orientation and projection page width
     if options.map_orientation:
         orientation_projection = "-P -JM13c"
@@ -194,8 +173,6 @@ def main(argv):
             orientation_projection,
             output_file_name)
     # Remove temporary files
-    if os.path.exists(TMP_FILE):
-        call(["rm",TMP_FILE])
     if os.path.exists("gmt.conf"):
         call(["rm","gmt.conf"])
 
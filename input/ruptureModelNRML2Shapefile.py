@@ -1,8 +1,11 @@
 #!/usr/bin/python
 
 """
-Reads rupture model file in NRML fomat and converts it to shapefile.
+Reads rupture model files in NRML fomat and converts them to shapefile.
 Supports NRML format 0.3.
+Any number of simple and complex fault ruptures, from one or many files,
+are streamed one at a time, their surface meshes are built by a pool
+of processes, and all the rupture polygons go to a single shapefile.
 Required libraries are:
 - lxml
 - pyshp
@@ -13,6 +16,8 @@ Required libraries are:
 import sys
 import math
 import argparse
+import itertools
+import multiprocessing
 import shapefile
 from lxml import etree
 import numpy
@@ -23,7 +28,14 @@ from nhlib.geo import Point, Line
 xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
 xmlGML = '{http://www.opengis.net/gml}'
 
+SIMPLE_FAULT_RUPTURE = '%ssimpleFaultRupture' % xmlNRML
+COMPLEX_FAULT_RUPTURE = '%scomplexFaultRupture' % xmlNRML
+
+# number of ruptures sent at once to each process
+CHUNK_SIZE = 16
+
 w_poly = shapefile.Writer(shapefile.POLYGON)
+w_poly.field('ID','C','40')
 w_poly.field('TECTONIC REGION TYPE','C','40')
 w_poly.field('MAGNITUDE (Mw)','N',10,1)
 w_poly.field('RAKE','N',10,1)
@@ -32,38 +44,100 @@ def set_up_arg_parser():
 	"""
 	Set up command line parser.
 	"""
-	parser = argparse.ArgumentParser(description='Convert NRML format rupture model file to shapefile.'\
+	parser = argparse.ArgumentParser(description='Convert NRML format rupture model files to shapefile.'\
 					'The obtained shapefile contains rupture plane coordinates, tectonic region type, magnitude, rake'\
 					'To run just type: '\
 					'python ruptureModelNRML2Shapefile.py --rupture-model-file=/PATH/RUPTURE_MODEL_FILE_NAME.xml')
-	parser.add_argument('--rupture-model-file',help='path to NRML rupture model file',default=None)
+	parser.add_argument('--rupture-model-file',help='path to NRML rupture model file(s)',
+					nargs='+',default=None)
+	parser.add_argument('--output-file',help='path of the shapefile, without extension '\
+					'(default: first rupture model file without extension)',default=None)
+	parser.add_argument('--processes',help='number of processes building the rupture surfaces',
+					type=int,default=multiprocessing.cpu_count())
 	return parser
 
-def parse_rupture_model_file(rupture_model_file):
+def read_ruptures(rupture_model_file):
+	"""
+	Yield, for each simple or complex fault rupture of NRML
+	rupture model file, a tuple with the data needed to compute its
+	polygon: (rupture type, ID, tectonic region type, magnitude, rake,
+	geometry parameters). Each rupture element is freed after use.
+	"""
+	for _, element in etree.iterparse(rupture_model_file,
+			tag=(SIMPLE_FAULT_RUPTURE,COMPLEX_FAULT_RUPTURE)):
+		if element.tag == SIMPLE_FAULT_RUPTURE:
+			yield parse_simple_fault_rupture(element)
+		else:
+			yield parse_complex_fault_rupture(element)
+		element.clear()
+		while element.getprevious() is not None:
+			del element.getparent()[0]
+
+def parse_rupture(element):
+	"""
+	Return ID, tectonic region type, magnitude and rake of a rupture.
+	"""
+	return (element.get('%sid' % xmlGML),
+		element.findtext('%stectonicRegion' % xmlNRML),
+		float(element.findtext('%smagnitude' % xmlNRML)),
+		float(element.findtext('%srake' % xmlNRML)))
+
+def parse_simple_fault_rupture(element):
 	"""
-	Parse NRML simpleFaultRupture.
+	Parse NRML simpleFaultRupture, and extract fault geometry
+	(trace position list, upper and lower seismogenic depths, dip).
 	"""
-	parse_args = dict(source=rupture_model_file)
+	geometry = element.find('%ssimpleFaultGeometry' % xmlNRML)
+	posList = next(geometry.iter('%sposList' % xmlGML)).text
+	upper_seismo_depth = float(geometry.findtext('%supperSeismogenicDepth' % xmlNRML))
+	lower_seismo_depth = float(geometry.findtext('%slowerSeismogenicDepth' % xmlNRML))
+	dip = float(geometry.findtext('%sdip' % xmlNRML))
+
+	return ('simpleFault',) + parse_rupture(element) + \
+		((posList,upper_seismo_depth,lower_seismo_depth,dip),)
 
-	for _, element in etree.iterparse(**parse_args):
-		if element.tag == '%smagnitude' % xmlNRML:
-			magnitude = float(element.text)
-		if element.tag == '%stectonicRegion' % xmlNRML:
-			tect_reg_type = element.text
-		if element.tag == '%srake' % xmlNRML:
-			rake = float(element.text)
-		if element.tag == '%sposList' % xmlGML:
-			posList = element.text
-		if element.tag == '%sdip' % xmlNRML:
-			dip = float(element.text)
-		if element.tag == '%supperSeismogenicDepth' % xmlNRML:
-			upper_seismo_depth = float(element.text)
-		if element.tag == '%slowerSeismogenicDepth' % xmlNRML:
-			lower_seismo_depth = float(element.text)
+def parse_complex_fault_rupture(element):
+	"""
+	Parse NRML complexFaultRupture, and extract fault geometry
+	(top and bottom edge position lists).
+	"""
+	fault_top_edge = next(element.iter('%sfaultTopEdge' % xmlNRML))
+	fault_bottom_edge = next(element.iter('%sfaultBottomEdge' % xmlNRML))
 
-	polygon, area = get_polygon_area_from_simple_fault_data(posList,upper_seismo_depth,lower_seismo_depth,dip)
+	return ('complexFault',) + parse_rupture(element) + \
+		((next(fault_top_edge.iter('%sposList' % xmlGML)).text,
+		next(fault_bottom_edge.iter('%sposList' % xmlGML)).text),)
 
-	return polygon, tect_reg_type, magnitude, rake
+def compute_rupture_data(rupture):
+	"""
+	Compute polygon of a rupture, as read by read_ruptures.
+	Return polygon, ID, tectonic region type, magnitude and rake.
+	"""
+	rupture_type,ID,tect_reg_type,magnitude,rake,geometry = rupture
+	if rupture_type == 'simpleFault':
+		polygon, _ = get_polygon_area_from_simple_fault_data(*geometry)
+	else:
+		polygon = get_polygon_from_complex_fault_data(*geometry)
+	return polygon, ID, tect_reg_type, magnitude, rake
+
+def parse_rupture_model_files(rupture_model_files,processes=1):
+	"""
+	Parse NRML rupture model files and yield the data of each
+	rupture, as returned by compute_rupture_data, in file order.
+	Polygons are computed in parallel if processes > 1.
+	"""
+	ruptures = itertools.chain.from_iterable(
+		read_ruptures(rupture_model_file) for rupture_model_file in rupture_model_files)
+
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+		for data in pool.imap(compute_rupture_data,ruptures,CHUNK_SIZE):
+			yield data
+		pool.close()
+		pool.join()
+	else:
+		for rupture in ruptures:
+			yield compute_rupture_data(rupture)
 
 def get_polygon_area_from_simple_fault_data(posList,upper_seismo_depth,lower_seismo_depth,dip):
 
@@ -96,16 +170,43 @@ def get_polygon_area_from_simple_fault_data(posList,upper_seismo_depth,lower_sei
 
 	return polygon, length * width
 
-def serialize_data_to_shapefile(polygon,tect_reg_type,mag,rake,file_name):
+def get_polygon_from_complex_fault_data(fault_top_edge,fault_bottom_edge):
+
+	fault_top_edge = fault_top_edge.split()
+	fault_top_edge = numpy.array(fault_top_edge,dtype=float).reshape(len(fault_top_edge)/3,3)
+	fault_top_edge = Line([Point(v1,v2,v3) for v1,v2,v3 in fault_top_edge])
+
+	fault_bottom_edge = fault_bottom_edge.split()
+	fault_bottom_edge = numpy.array(fault_bottom_edge,dtype=float).reshape(len(fault_bottom_edge)/3,3)
+	fault_bottom_edge = Line([Point(v1,v2,v3) for v1,v2,v3 in fault_bottom_edge])
+
+	# create complex fault surface
+	surf = ComplexFaultSurface.from_fault_data([fault_top_edge,fault_bottom_edge], mesh_spacing = 2.0)
+
+	# extract fault boundary
+	polygon = []
+	fault_boundary = surf.get_mesh()._get_bounding_mesh()
+	for lon,lat in zip(fault_boundary.lons,fault_boundary.lats):
+		polygon.append([lon,lat])
+
+	return polygon
+
+def serialize_data_to_shapefile(rupture_data,file_name):
 	"""
-	Serialize rupture data to shapefile.
+	Serialize data of all the ruptures to shapefile.
 	"""
-	w_poly.poly(parts=[polygon])
-	w_poly.record(tect_reg_type,round(mag,1),round(rake,1))
+	n_ruptures = 0
+	for polygon,ID,tect_reg_type,mag,rake in rupture_data:
+		w_poly.poly(parts=[polygon])
+		w_poly.record(ID,tect_reg_type,round(mag,1),round(rake,1))
+		n_ruptures += 1
+
+	if n_ruptures == 0:
+		raise RuntimeError('No simple or complex fault rupture found')
 
 	w_poly.save(file_name)
 
-	print 'Shapefile saved to: %s.shp' % file_name
+	print '%d ruptures saved to: %s.shp' % (n_ruptures,file_name)
 
 def main(argv):
 	"""
@@ -115,8 +216,11 @@ def main(argv):
 	args = parser.parse_args()
 
 	if args.rupture_model_file:
-		polygon, tect_reg_type, mag, rake = parse_rupture_model_file(args.rupture_model_file)
-		serialize_data_to_shapefile(polygon,tect_reg_type,mag,rake,args.rupture_model_file.split('.')[0])
+		file_name = args.output_file
+		if file_name is None:
+			file_name = args.rupture_model_file[0].split('.')[0]
+		serialize_data_to_shapefile(
+			parse_rupture_model_files(args.rupture_model_file,args.processes),file_name)
 	else:
 		parser.print_help()
 
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+"""
+Reads source model file in NRML format and computes the regional
+magnitude frequency distribution (the sum of the MFDs of all the sources)
+and a map of the occurrence rates on a regular lon/lat grid.
+The total occurrence rate of each area source is spread evenly over the
+grid cells whose centre is inside its polygon, the rate of each fault
+source over the cells inside its surface boundary, and the rate of each
+point source goes to the cell containing it.
+Grids are saved to a .npz file and as ESRI ASCII grids (occurrence rate
+and occurrence rate per square kilometer), and the regional MFD to the
+.npz file and to a .CSV file.
+Supports NRML format 0.3.
+Required libraries are:
+- lxml
+- numpy
+- nhlib
+- shapely
+"""
+
+import os
+import sys
+import csv
+import argparse
+import multiprocessing
+import numpy
+import sourceModelNRML2Shapefile
+
+# mean earth radius in km
+EARTH_RADIUS = 6371.0
+
+def set_up_arg_parser():
+	"""
+	Set up command line parser.
+	"""
+	parser = argparse.ArgumentParser(description='Compute regional MFD and occurrence rate grid'\
+					' of a NRML format source model file.'\
+					'To run just type: python sourceModelNRML2RateGrid.py --source-model-file=/PATH/SOURCE_MODEL_FILE_NAME.xml')
+	parser.add_argument('--source-model-file',help='path to NRML source model file',default=None)
+	parser.add_argument('--grid-spacing',help='grid spacing in degrees',type=float,default=0.1)
+	parser.add_argument('--mfd-bin-width',help='width of the magnitude bins of the regional MFD',
+					type=float,default=0.1)
+	parser.add_argument('--processes',help='number of processes computing source geometries',
+					type=int,default=multiprocessing.cpu_count())
+	parser.add_argument('--cache-dir',help='folder caching fault polygons and areas',
+					default=sourceModelNRML2Shapefile.DEFAULT_CACHE_DIR)
+	parser.add_argument('--cache-size',help='maximum size of the cache in MB',
+					type=float,default=100.0)
+	parser.add_argument('--no-cache',help='do not cache fault polygons and areas',
+					action='store_true',default=False)
+	return parser
+
+class RateGrid(object):
+	"""
+	Regular lon/lat grid of occurrence rates, with cells aligned
+	on multiples of the spacing. Row 0 is the southernmost row.
+	"""
+
+	def __init__(self,west,south,east,north,spacing):
+		self.spacing = spacing
+		self.lon_0 = numpy.floor(west / spacing) * spacing
+		self.lat_0 = numpy.floor(south / spacing) * spacing
+		self.n_lons = int((east - self.lon_0) // spacing) + 1
+		self.n_lats = int((north - self.lat_0) // spacing) + 1
+		self.rates = numpy.zeros((self.n_lats,self.n_lons))
+
+	def get_cells(self,lons,lats):
+		"""
+		Return row and column of the cells containing the points.
+		"""
+		columns = ((numpy.asarray(lons) - self.lon_0) // self.spacing).astype(int)
+		rows = ((numpy.asarray(lats) - self.lat_0) // self.spacing).astype(int)
+		return (numpy.clip(rows,0,self.n_lats - 1),
+			numpy.clip(columns,0,self.n_lons - 1))
+
+	def add_point(self,lon,lat,rate):
+		"""
+		Add rate to the cell containing a point.
+		"""
+		row,column = self.get_cells(lon,lat)
+		self.rates[row,column] += rate
+
+	def add_polygon(self,polygon,rate):
+		"""
+		Spread rate evenly over the cells whose centre is inside polygon,
+		or, if the polygon contains no cell centre, over the cells
+		containing its vertices.
+		"""
+		polygon = numpy.asarray(polygon,dtype=float)
+		(row_min,row_max),(col_min,col_max) = self.get_cells(
+			[polygon[:,0].min(),polygon[:,0].max()],
+			[polygon[:,1].min(),polygon[:,1].max()])
+
+		rows,columns = numpy.mgrid[row_min:row_max + 1,col_min:col_max + 1]
+		rows = rows.ravel()
+		columns = columns.ravel()
+		inside = points_in_polygon(self.lon_0 + (columns + 0.5) * self.spacing,
+			self.lat_0 + (rows + 0.5) * self.spacing,polygon)
+
+		if inside.any():
+			rows = rows[inside]
+			columns = columns[inside]
+		else:
+			rows,columns = self.get_cells(polygon[:,0],polygon[:,1])
+			cells = numpy.unique(rows * self.n_lons + columns)
+			rows,columns = cells // self.n_lons,cells % self.n_lons
+		self.rates[rows,columns] += rate / len(rows)
+
+	def get_cell_areas(self):
+		"""
+		Return the area in squared kilometers of the cells of each row.
+		"""
+		lats = numpy.radians(self.lat_0 + numpy.arange(self.n_lats + 1) * self.spacing)
+		return EARTH_RADIUS ** 2 * numpy.radians(self.spacing) * \
+			numpy.abs(numpy.diff(numpy.sin(lats)))
+
+	def get_densities(self):
+		"""
+		Return occurrence rates per squared kilometer.
+		"""
+		return self.rates / self.get_cell_areas()[:,numpy.newaxis]
+
+	def get_lons(self):
+		"""
+		Return longitudes of the cell centres.
+		"""
+		return self.lon_0 + (numpy.arange(self.n_lons) + 0.5) * self.spacing
+
+	def get_lats(self):
+		"""
+		Return latitudes of the cell centres.
+		"""
+		return self.lat_0 + (numpy.arange(self.n_lats) + 0.5) * self.spacing
+
+def points_in_polygon(lons,lats,polygon):
+	"""
+	Return a boolean array telling which points are inside polygon,
+	with the even-odd rule: a point is inside if a ray starting from
+	it crosses an odd number of polygon edges.
+	"""
+	inside = numpy.zeros(len(lons),dtype=bool)
+	x1,y1 = polygon[:,0],polygon[:,1]
+	x2,y2 = numpy.roll(x1,-1),numpy.roll(y1,-1)
+	for i in range(len(polygon)):
+		if y1[i] == y2[i]:
+			continue
+		crosses = (y1[i] > lats) != (y2[i] > lats)
+		x_cross = x1[i] + (lats - y1[i]) * (x2[i] - x1[i]) / (y2[i] - y1[i])
+		inside ^= crosses & (lons < x_cross)
+	return inside
+
+def get_extent(source_data):
+	"""
+	Return west, south, east, north boundaries of all the sources.
+	Raise RuntimeError if there is no source.
+	"""
+	if not source_data:
+		raise RuntimeError('No source found')
+	coords = []
+	for data in source_data:
+		if data['POLYGON'] is not None:
+			coords.extend(data['POLYGON'])
+		if data['POINT'] is not None:
+			coords.append(data['POINT'][:2])
+	coords = numpy.array(coords,dtype=float)
+	return coords[:,0].min(),coords[:,1].min(),coords[:,0].max(),coords[:,1].max()
+
+def compute_rate_grid(sources,source_data,spacing):
+	"""
+	Return RateGrid with the total occurrence rates of the sources,
+	given as read by read_sources and as computed by compute_sources_data.
+	"""
+	grid = RateGrid(*(get_extent(source_data) + (spacing,)))
+	for source,data in zip(sources,source_data):
+		tot_occ_rate = source[5]
+		if data['POINT'] is not None:
+			grid.add_point(data['POINT'][0],data['POINT'][1],tot_occ_rate)
+		else:
+			grid.add_polygon(data['POLYGON'],tot_occ_rate)
+	return grid
+
+def get_regional_mfd(sources,mfds,bin_width):
+	"""
+	Return magnitude bin edges and the sum of the binned
+	occurrence rates of all the sources, both empty if
+	no source has a MFD.
+	"""
+	if not len(mfds):
+		print 'No source has a MFD, regional MFD is empty'
+		return numpy.zeros(0), numpy.zeros(0)
+	mag_edges = mfds.get_mag_edges(bin_width)
+	return mag_edges, mfds.get_binned_rates(len(sources),mag_edges).sum(axis=0)
+
+def save_esri_ascii_grid(values,grid,file_name):
+	"""
+	Save grid values to ESRI ASCII grid file, northernmost row first.
+	"""
+	with open(file_name,'w') as f:
+		f.write('ncols %d\n' % grid.n_lons)
+		f.write('nrows %d\n' % grid.n_lats)
+		f.write('xllcorner %s\n' % grid.lon_0)
+		f.write('yllcorner %s\n' % grid.lat_0)
+		f.write('cellsize %s\n' % grid.spacing)
+		f.write('NODATA_value -9999\n')
+		numpy.savetxt(f,values[::-1],fmt='%.6e')
+	print 'Grid saved to: %s' % file_name
+
+def save_results(grid,mag_edges,mfd_rates,file_name):
+	"""
+	Save rate grids and regional MFD to .npz, ESRI ASCII grid and .CSV files.
+	"""
+	numpy.savez(file_name + '_rates.npz',lons=grid.get_lons(),lats=grid.get_lats(),
+		rates=grid.rates,densities=grid.get_densities(),
+		mag_edges=mag_edges,mfd_rates=mfd_rates)
+	print 'Grids and MFD saved to: %s_rates.npz' % file_name
+
+	save_esri_ascii_grid(grid.rates,grid,file_name + '_rates.asc')
+	save_esri_ascii_grid(grid.get_densities(),grid,file_name + '_densities.asc')
+
+	with open(file_name + '_mfd.csv','wb') as f:
+		writer = csv.writer(f)
+		writer.writerow(['min_mag','max_mag','occurrence_rate'])
+		for lo,hi,rate in zip(mag_edges[:-1],mag_edges[1:],mfd_rates):
+			writer.writerow(['%.2f' % lo,'%.2f' % hi,'%.6e' % rate])
+	print 'Regional MFD saved to: %s_mfd.csv' % file_name
+
+def main(argv):
+	"""
+	Parse command line argument and performs requested action.
+	"""
+	parser = set_up_arg_parser()
+	args = parser.parse_args()
+
+	if args.source_model_file:
+		if not args.no_cache:
+			sourceModelNRML2Shapefile.init_geometry_cache(
+				args.cache_dir,args.cache_size * 1024 * 1024)
+		sources, mfds = sourceModelNRML2Shapefile.read_sources(args.source_model_file)
+		if not sources:
+			print 'No source found in %s' % args.source_model_file
+			sys.exit(1)
+		source_data = sourceModelNRML2Shapefile.compute_sources_data(sources,args.processes)
+		sourceModelNRML2Shapefile.evict_geometry_cache()
+
+		grid = compute_rate_grid(sources,source_data,args.grid_spacing)
+		mag_edges, mfd_rates = get_regional_mfd(sources,mfds,args.mfd_bin_width)
+		save_results(grid,mag_edges,mfd_rates,os.path.splitext(args.source_model_file)[0])
+	else:
+		parser.print_help()
+
+if __name__=='__main__':
+
+	main(sys.argv)
@@ -3,6 +3,11 @@
 """
 Reads source model file in NRML fomat and converts it to shapefile.
 Supports NRML format 0.3.
+Sources are read in a first fast pass over the file, then their
+polygons, areas and rates are computed by a pool of processes.
+Boundary polygon and area of fault sources are cached on disk, keyed on
+a hash of the fault geometry, so that converting again a source model
+only recomputes the fault surfaces that changed.
 Required libraries are:
 - lxml
 - pyshp
@@ -11,9 +16,15 @@ Required libraries are:
 - shapely
 """
 
+import os
+import csv
 import sys
 import math
+import glob
+import hashlib
+import cPickle
 import argparse
+import multiprocessing
 import shapefile
 from lxml import etree
 import numpy
@@ -21,10 +32,15 @@ import shapely
 from nhlib.geo import _utils
 from nhlib.geo.surface import SimpleFaultSurface, ComplexFaultSurface
 from nhlib.geo import Point, Line
+from source_model_mfd import MFDCollection, MFD_TAGS, xmlNRML
 
-xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
 xmlGML = '{http://www.opengis.net/gml}'
 
+# bump when the computation of fault polygons and areas changes,
+# to ignore the values cached by previous versions
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.sourceModelNRML2Shapefile')
+
 w_point = shapefile.Writer(shapefile.POINT)
 w_point.field('ID','C','40')
 w_point.field('NAME','C','40')
@@ -50,78 +66,224 @@ def set_up_arg_parser():
 					'If the source model contains both polygon shaped sources (area and/or simple fault and/or complex fault)'\
 					'and point sources, two shapefile are created (one for polygons and one for points).')
 	parser.add_argument('--source-model-file',help='path to NRML source model file',default=None)
+	parser.add_argument('--cache-dir',help='folder caching fault polygons and areas',
+					default=DEFAULT_CACHE_DIR)
+	parser.add_argument('--cache-size',help='maximum size of the cache in MB',
+					type=float,default=100.0)
+	parser.add_argument('--no-cache',help='do not cache fault polygons and areas',
+					action='store_true',default=False)
+	parser.add_argument('--processes',help='number of processes computing source geometries',
+					type=int,default=multiprocessing.cpu_count())
+	parser.add_argument('--mfd-table',help='path to .CSV file where the occurrence rates of each'\
+					' source, per magnitude bin, are saved',default=None)
+	parser.add_argument('--mfd-bin-width',help='width of the magnitude bins of the MFD table',
+					type=float,default=0.1)
 	return parser
 
-def parse_source_model_file(source_model_file):
+class GeometryCache(object):
+	"""
+	On disk cache of fault geometries, one pickle file per entry.
+	Entries are touched when read, and the least recently used ones
+	are removed when the cache exceeds its maximum size (in bytes).
+	"""
+
+	def __init__(self,cache_dir,max_size):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def _path(self,key):
+		return os.path.join(self.cache_dir,'%s.pickle' % key)
+
+	def get(self,key):
+		"""
+		Return cached value of key, or None.
+		"""
+		path = self._path(key)
+		try:
+			with open(path,'rb') as f:
+				value = cPickle.load(f)
+		except (IOError,EOFError,cPickle.UnpicklingError):
+			return None
+		os.utime(path,None)
+		return value
+
+	def put(self,key,value):
+		"""
+		Store value of key. The file is written under a temporary
+		name and then renamed, so readers never see partial entries.
+		"""
+		path = self._path(key)
+		tmp_path = '%s.%s.tmp' % (path,os.getpid())
+		with open(tmp_path,'wb') as f:
+			cPickle.dump(value,f,cPickle.HIGHEST_PROTOCOL)
+		os.rename(tmp_path,path)
+
+	def evict(self):
+		"""
+		Remove least recently used entries until the cache
+		is not larger than its maximum size.
+		"""
+		entries = []
+		for path in glob.glob(os.path.join(self.cache_dir,'*.pickle')):
+			stat = os.stat(path)
+			entries.append((stat.st_mtime,stat.st_size,path))
+		size = sum(s for _,s,_ in entries)
+		for _,entry_size,path in sorted(entries):
+			if size <= self.max_size:
+				break
+			os.remove(path)
+			size -= entry_size
+
+# cache of fault geometries of the current process,
+# set by init_geometry_cache
+_geometry_cache = None
+
+def init_geometry_cache(cache_dir,max_size):
+	"""
+	Set the geometry cache of the current process,
+	or disable it if cache_dir is None.
+	"""
+	global _geometry_cache
+	_geometry_cache = None
+	if cache_dir is not None:
+		_geometry_cache = GeometryCache(cache_dir,max_size)
+
+def evict_geometry_cache():
+	"""
+	Shrink the geometry cache of the current process
+	to its maximum size, if the cache is enabled.
+	"""
+	if _geometry_cache is not None:
+		_geometry_cache.evict()
+
+def get_cache_key(*params):
+	"""
+	Return hash of params.
+	"""
+	return hashlib.sha1(repr((CACHE_VERSION,) + params)).hexdigest()
+
+def get_cached_geometry(func,*params):
+	"""
+	Return func(*params), from the geometry cache if there.
+	"""
+	if _geometry_cache is None:
+		return func(*params)
+	key = get_cache_key(func.__name__,*params)
+	value = _geometry_cache.get(key)
+	if value is None:
+		value = func(*params)
+		_geometry_cache.put(key,value)
+	return value
+
+def parse_source_model_file(source_model_file,processes=1):
 	"""
 	Parse NRML format source model file
-	and returns list of source data,
+	and returns list of source data, in file order,
 	each source data being a dictionary:
 	src_data = {'ID':id,'NAME':name,'POINT',point,'POLYGON':polygon,'MAX_MAG','TOT_OCC_RATE'}
 	"""
-	data = []
+	sources, _ = read_sources(source_model_file)
+	return compute_sources_data(sources,processes)
+
+def compute_sources_data(sources,processes=1):
+	"""
+	Compute source data of each source read by read_sources,
+	in parallel if processes > 1. Source order is preserved.
+	"""
+	if processes > 1 and len(sources) > 1:
+		cache_args = (None,None)
+		if _geometry_cache is not None:
+			cache_args = (_geometry_cache.cache_dir,_geometry_cache.max_size)
+		pool = multiprocessing.Pool(processes,init_geometry_cache,cache_args)
+		chunksize = max(len(sources) // (processes * 4),1)
+		data = pool.map(compute_source_data,sources,chunksize)
+		pool.close()
+		pool.join()
+	else:
+		data = map(compute_source_data,sources)
+
+	return data
+
+def read_sources(source_model_file):
+	"""
+	Parse NRML format source model file and return, for each source,
+	a tuple with the data needed to compute its geometry:
+	(source type, ID, name, geometry parameters, maximum magnitude, total occurrence rate),
+	and the MFDCollection with the MFDs of all the sources.
+	Maximum magnitude and total occurrence rate account for all the MFDs of a source.
+	"""
+	sources = []
+	mfds = MFDCollection()
 	parse_args = dict(source=source_model_file)
 
 	for _, element in etree.iterparse(**parse_args):
 		if element.tag == '%sareaSource' % xmlNRML:
-			ID,name,point,polygon,max_mag,tot_occ_rate = parse_area_source(element)
-			src_data = {'ID':ID,
-				'NAME':name,
-				'POINT':point,
-				'POLYGON':polygon,
-				'MAX_MAG':round(max_mag,1),
-				'TOT_OCC_RATE':round(tot_occ_rate,14)}
-			data.append(src_data)
-		if element.tag == '%spointSource' % xmlNRML:
-			ID,name,point,polygon,max_mag,tot_occ_rate = parse_point_source(element)
-			src_data = {'ID':ID,
-				'NAME':name,
-				'POINT':point,
-				'POLYGON':polygon,
-				'MAX_MAG':round(max_mag,1),
-				'TOT_OCC_RATE':round(tot_occ_rate,14)}
-			data.append(src_data)
-		if element.tag == '%ssimpleFaultSource' % xmlNRML:
-			ID,name,point,polygon,max_mag,tot_occ_rate = parse_simple_fault_source(element)
-			src_data = {'ID':ID,
-				'NAME':name,
-				'POINT':point,
-				'POLYGON':polygon,
-				'MAX_MAG':round(max_mag,1),
-				'TOT_OCC_RATE':round(tot_occ_rate,14)}
-			data.append(src_data)
-		if element.tag == '%scomplexFaultSource' % xmlNRML:
-			ID,name,point,polygon,max_mag,tot_occ_rate = parse_complex_fault_source(element)
-			src_data = {'ID':ID,
-				'NAME':name,
-				'POINT':point,
-				'POLYGON':polygon,
-				'MAX_MAG':round(max_mag,1),
-				'TOT_OCC_RATE':round(tot_occ_rate,14)}
-			data.append(src_data)
-
-	return data
+			source = parse_area_source(element)
+		elif element.tag == '%spointSource' % xmlNRML:
+			source = parse_point_source(element)
+		elif element.tag == '%ssimpleFaultSource' % xmlNRML:
+			source = parse_simple_fault_source(element)
+		elif element.tag == '%scomplexFaultSource' % xmlNRML:
+			source = parse_complex_fault_source(element)
+		else:
+			continue
+		for e in element.iter(*MFD_TAGS):
+			mfds.add_element(len(sources),e)
+		sources.append(source)
+		element.clear()
+
+	max_mags, tot_occ_rates = mfds.get_totals(len(sources))
+	sources = [source + (max_mag,tot_occ_rate) for source,max_mag,tot_occ_rate
+		in zip(sources,max_mags.tolist(),tot_occ_rates.tolist())]
+
+	return sources, mfds
+
+def compute_source_data(source):
+	"""
+	Compute point or polygon of a source, as read by read_sources,
+	and normalize its total occurrence rate by its area.
+	Return source data dictionary.
+	"""
+	source_type,ID,name,geometry,max_mag,tot_occ_rate = source
+	point = None
+	polygon = None
+
+	if source_type == 'area':
+		polygon = get_polygon_from_2DLinestring(*geometry)
+		# normalize occurrence rate by polygon area
+		tot_occ_rate = tot_occ_rate / get_polygon_area(polygon)
+	elif source_type == 'point':
+		point = numpy.array(geometry[0].split(),dtype=float)
+	elif source_type == 'simpleFault':
+		polygon, area = get_cached_geometry(get_polygon_area_from_simple_fault_data,*geometry)
+		# normalize total occurrence rate by area
+		tot_occ_rate = tot_occ_rate / area
+	elif source_type == 'complexFault':
+		polygon, area = get_cached_geometry(get_polygon_area_from_complex_fault_data,*geometry)
+		tot_occ_rate = tot_occ_rate / area
+
+	return {'ID':ID,
+		'NAME':name,
+		'POINT':point,
+		'POLYGON':polygon,
+		'MAX_MAG':round(max_mag,1),
+		'TOT_OCC_RATE':round(tot_occ_rate,14)}
 
 def parse_area_source(element):
 	"""
 	Parse NRML area source element, and extract:
-	ID, name, area boundary (as polygon), maximum magnitude (the maximum among all
-	the maximum magnitudes from all the FMD defined),
-	total occurrence rate (by summing occurrence rates from all the FMD defined)
+	ID, name, area boundary (as position list).
 	"""
 	ID = element.get('%sid' % xmlGML)
 	for e in element.iter():
 		if e.tag == '%sname' % xmlGML:
 			name = e.text
 		if e.tag == '%sposList' % xmlGML:
-			polygon = get_polygon_from_2DLinestring(e.text)
-		if e.tag == '%sruptureRateModel' % xmlNRML:
-			max_mag, tot_occ_rate = parse_rupture_rate_model(e)
-
-	# normalize occurrence rate by polygon area
-	tot_occ_rate = tot_occ_rate / get_polygon_area(polygon)
+			posList = e.text
 
-	return ID,name,None,polygon,max_mag,tot_occ_rate
+	return 'area',ID,name,(posList,)
 
 def get_polygon_from_2DLinestring(polygon):
 	"""
@@ -154,26 +316,22 @@ def get_polygon_area(polygon):
 def parse_point_source(element):
 	"""
 	Parse NRML point source element, and extract:
-	ID, name, point coordinates (as point), maximum magnitude (the maximum among all
-	the maximum magnitudes from all the FMD defined),
-	total occurrence rate (by summing occurrence rates from all the FMD defined)
+	ID, name, point coordinates (as position).
 	"""
 	ID = element.get('%sid' % xmlGML)
 	for e in element.iter():
 		if e.tag == '%sname' % xmlGML:
 			name = e.text
 		if e.tag == '%spos' % xmlGML:
-			point = numpy.array(e.text.split(),dtype=float)
-		if e.tag == '%sruptureRateModel' % xmlNRML:
-			max_mag, tot_occ_rate = parse_rupture_rate_model(e)
+			pos = e.text
 
-	return ID,name,point,None,max_mag,tot_occ_rate
+	return 'point',ID,name,(pos,)
 
 def parse_simple_fault_source(element):
 	"""
 	Parse NRML simple fault source, and extract:
-	ID, name, fault surface boundary (as polygon),
-	maximum magnitude, total occurrence rate.
+	ID, name, fault geometry (top edge position list,
+	upper and lower seismogenic depth, dip).
 	"""
 	ID = element.get('%sid' % xmlGML)
 	for e in element.iter():
@@ -187,17 +345,8 @@ def parse_simple_fault_source(element):
 			upper_seismo_depth = float(e.text)
 		if e.tag == '%slowerSeismogenicDepth' % xmlNRML:
 			lower_seismo_depth = float(e.text)
-		if e.tag == '%struncatedGutenbergRichter' % xmlNRML:
-			max_mag, tot_occ_rate = parse_truncated_gutenberg_richter(e)
-		if e.tag == '%sevenlyDiscretizedIncrementalMFD' % xmlNRML:
-			max_mag, tot_occ_rate = parse_incremental_mfd(e)
-
-	polygon, area = get_polygon_area_from_simple_fault_data(posList,upper_seismo_depth,lower_seismo_depth,dip)
-
-	# normalize total occurrence rate by area
-	tot_occ_rate = tot_occ_rate / area
 
-	return ID,name,None,polygon,max_mag,tot_occ_rate
+	return 'simpleFault',ID,name,(posList,upper_seismo_depth,lower_seismo_depth,dip)
 
 def get_polygon_area_from_simple_fault_data(posList,upper_seismo_depth,lower_seismo_depth,dip):
 
@@ -233,8 +382,7 @@ def get_polygon_area_from_simple_fault_data(posList,upper_seismo_depth,lower_sei
 def parse_complex_fault_source(element):
 	"""
 	Parse NRML complex fault source, and extract:
-	ID, name, fault surface boundary (as polygon),
-	maximum magnitude, total occurrence rate.
+	ID, name, fault geometry (top and bottom edge position lists).
 	"""
 	ID = element.get('%sid' % xmlGML)
 	for e in element.iter():
@@ -244,16 +392,8 @@ def parse_complex_fault_source(element):
 			fault_top_edge = e.find('%sLineString' % xmlGML).findtext('%sposList' % xmlGML)
 		if e.tag == '%sfaultBottomEdge' % xmlNRML:
 			fault_bottom_edge = e.find('%sLineString' % xmlGML).findtext('%sposList' % xmlGML)
-		if e.tag == '%struncatedGutenbergRichter' % xmlNRML:
-			max_mag, tot_occ_rate = parse_truncated_gutenberg_richter(e)
-		if e.tag == '%sevenlyDiscretizedIncrementalMFD' % xmlNRML:
-			max_mag, tot_occ_rate = parse_incremental_mfd(e)
-
-	polygon,area = get_polygon_area_from_complex_fault_data(fault_top_edge,fault_bottom_edge)
-
-	tot_occ_rate = tot_occ_rate / area
 
-	return ID,name,None,polygon,max_mag,tot_occ_rate
+	return 'complexFault',ID,name,(fault_top_edge,fault_bottom_edge)
 
 def get_polygon_area_from_complex_fault_data(fault_top_edge,fault_bottom_edge):
 	
@@ -281,61 +421,35 @@ def get_polygon_area_from_complex_fault_data(fault_top_edge,fault_bottom_edge):
 
 	return polygon, area
 
-def parse_rupture_rate_model(element):
+def write_mfd_table(sources,mfds,bin_width,file_name):
 	"""
-	Parse NRML rupture rate model, and extract:
-	- maximum magnitude (the maximum among all the maximum magnitudes from all the FMD defined),
-	- total occurrence rate (by summing occurrence rates from all the FMD defined)
+	Save the occurrence rates of each source per magnitude bin
+	to .CSV file, one row per source and one column per bin.
+	Nothing is saved if no source has a MFD.
 	"""
-	max_mags = []
-	tot_occ_rate = 0.0
-	
-	for e in element.iter():
-		if e.tag == '%struncatedGutenbergRichter' % xmlNRML:
-			max_mag, occ_rate = parse_truncated_gutenberg_richter(e)
-		if e.tag == '%sevenlyDiscretizedIncrementalMFD' % xmlNRML:
-			max_mag, occ_rate = parse_incremental_mfd(e)
-		
-	max_mags.append(max_mag)
-	tot_occ_rate += occ_rate
-	
-	return max(max_mags),tot_occ_rate
+	if not len(mfds):
+		print 'No source has a MFD, MFD table not saved'
+		return
 
-def parse_truncated_gutenberg_richter(element):
-	"""
-	Parse NRML truncated GR element, and returns maximum magnitude
-	and total occurrence rate.
-	"""
-	for e in element.iter():
-		if e.tag == '%saValueCumulative' % xmlNRML:
-			a_val = float(e.text)
-		if e.tag == '%sbValue' % xmlNRML:
-			b_val = float(e.text)
-		if e.tag == '%sminMagnitude' % xmlNRML:
-			min_mag = float(e.text)
-		if e.tag == '%smaxMagnitude' % xmlNRML:
-			max_mag = float(e.text)
-	
-	tot_occ_rate = pow(10.0,a_val - b_val * min_mag) - pow(10.0,a_val - b_val * max_mag)
-	
-	return max_mag, tot_occ_rate
+	mag_edges = mfds.get_mag_edges(bin_width)
+	table = mfds.get_binned_rates(len(sources),mag_edges)
 
-def parse_incremental_mfd(element):
-	"""
-	Parse NRML evenly discretized incremental MFD, and returns
-	maximum magnitude and total occurrence rate.
-	"""
-	rates = numpy.array(element.text.split(),dtype=float)
-	max_mag = float(element.attrib['minVal']) + (len(rates) - 1) * float(element.attrib['binSize'])
-	tot_occ_rate = numpy.sum(rates)
-	
-	return max_mag, tot_occ_rate
+	with open(file_name,'wb') as f:
+		writer = csv.writer(f)
+		writer.writerow(['ID'] + ['%.2f-%.2f' % (lo,hi) for lo,hi in zip(mag_edges[:-1],mag_edges[1:])])
+		for source,rates in zip(sources,table):
+			writer.writerow([source[1]] + ['%.6e' % rate for rate in rates])
+	print 'MFD table saved to: %s' % file_name
 
 def serialize_data_to_shapefile(source_data,file_name):
 	"""
 	Serialize source model data to shapefile.
+	Sources without MFD, having no maximum magnitude, are skipped.
 	"""
 	for data in source_data:
+		if math.isnan(data['MAX_MAG']):
+			print 'WARNING: source %s has no MFD, not saved to shapefile' % data['ID']
+			continue
 		if data['POLYGON'] is not None:
 			w_poly.poly(parts=[data['POLYGON']])
 			w_poly.record(data['ID'],data['NAME'],data['MAX_MAG'],data['TOT_OCC_RATE'])
@@ -364,8 +478,14 @@ def main(argv):
 	args = parser.parse_args()
 
 	if args.source_model_file:
-		source_data = parse_source_model_file(args.source_model_file)
+		if not args.no_cache:
+			init_geometry_cache(args.cache_dir,args.cache_size * 1024 * 1024)
+		sources, mfds = read_sources(args.source_model_file)
+		source_data = compute_sources_data(sources,args.processes)
 		serialize_data_to_shapefile(source_data,args.source_model_file.split('.')[0])
+		evict_geometry_cache()
+		if args.mfd_table:
+			write_mfd_table(sources,mfds,args.mfd_bin_width,args.mfd_table)
 	else:
 		parser.print_help()
 
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""
+Magnitude frequency distributions (MFDs) of the sources of a NRML source
+model, evaluated all at once with numpy.
+Parameters of truncated Gutenberg-Richter MFDs, and rates of evenly
+discretized incremental MFDs, are collected for the whole source model.
+Total occurrence rates, maximum magnitudes and binned magnitude frequency
+tables are then computed for every source in a single vectorized pass,
+summing all the MFDs of a source.
+Supports NRML format 0.3.
+Required libraries are:
+- numpy
+"""
+
+from array import array
+import numpy
+
+xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
+
+TRUNCATED_GR = '%struncatedGutenbergRichter' % xmlNRML
+INCREMENTAL_MFD = '%sevenlyDiscretizedIncrementalMFD' % xmlNRML
+MFD_TAGS = (TRUNCATED_GR, INCREMENTAL_MFD)
+
+class MFDCollection(object):
+	"""
+	MFDs of all the sources of a source model. Each MFD is
+	added with the index of its source, and a source can
+	have any number of MFDs.
+	"""
+
+	def __init__(self):
+		# truncated Gutenberg-Richter MFDs
+		self.gr_sources = array('l')
+		self.a_values = array('d')
+		self.b_values = array('d')
+		self.min_mags = array('d')
+		self.max_mags = array('d')
+		# incremental MFDs, with the rates of all
+		# the MFDs one after the other
+		self.inc_sources = array('l')
+		self.min_vals = array('d')
+		self.bin_sizes = array('d')
+		self.rates = array('d')
+		self.offsets = array('l',[0])
+
+	def __len__(self):
+		"""
+		Return the number of MFDs of all the sources.
+		"""
+		return len(self.gr_sources) + len(self.inc_sources)
+
+	def add_element(self,source_index,element):
+		"""
+		Add MFD from NRML truncatedGutenbergRichter or
+		evenlyDiscretizedIncrementalMFD element.
+		"""
+		if element.tag == TRUNCATED_GR:
+			self.add_truncated_gr(source_index,
+				float(element.findtext('%saValueCumulative' % xmlNRML)),
+				float(element.findtext('%sbValue' % xmlNRML)),
+				float(element.findtext('%sminMagnitude' % xmlNRML)),
+				float(element.findtext('%smaxMagnitude' % xmlNRML)))
+		elif element.tag == INCREMENTAL_MFD:
+			self.add_incremental(source_index,
+				float(element.get('minVal')),
+				float(element.get('binSize')),
+				numpy.array(element.text.split(),dtype=float))
+		else:
+			raise RuntimeError('Unknown MFD element: %s' % element.tag)
+
+	def add_truncated_gr(self,source_index,a_val,b_val,min_mag,max_mag):
+		"""
+		Add truncated Gutenberg-Richter MFD.
+		"""
+		self.gr_sources.append(source_index)
+		self.a_values.append(a_val)
+		self.b_values.append(b_val)
+		self.min_mags.append(min_mag)
+		self.max_mags.append(max_mag)
+
+	def add_incremental(self,source_index,min_val,bin_size,rates):
+		"""
+		Add evenly discretized incremental MFD.
+		"""
+		self.inc_sources.append(source_index)
+		self.min_vals.append(min_val)
+		self.bin_sizes.append(bin_size)
+		self.rates.extend(rates)
+		self.offsets.append(len(self.rates))
+
+	def _gr_arrays(self):
+		return [numpy.frombuffer(a,dtype=a.typecode) if len(a) else
+			numpy.zeros(0,dtype=a.typecode) for a in
+			(self.gr_sources,self.a_values,self.b_values,self.min_mags,self.max_mags)]
+
+	def _incremental_arrays(self):
+		return [numpy.frombuffer(a,dtype=a.typecode) if len(a) else
+			numpy.zeros(0,dtype=a.typecode) for a in
+			(self.inc_sources,self.min_vals,self.bin_sizes,self.rates,self.offsets)]
+
+	def get_totals(self,n_sources):
+		"""
+		Return maximum magnitude (the maximum among the maximum
+		magnitudes of its MFDs) and total occurrence rate (the sum
+		of the occurrence rates of its MFDs) of each source, as arrays.
+		Sources without MFDs have NaN maximum magnitude and zero rate.
+		"""
+		max_mags = numpy.empty(n_sources)
+		max_mags.fill(-numpy.inf)
+		tot_occ_rates = numpy.zeros(n_sources)
+
+		sources,a_vals,b_vals,min_mags,gr_max_mags = self._gr_arrays()
+		gr_rates = 10.0 ** (a_vals - b_vals * min_mags) - 10.0 ** (a_vals - b_vals * gr_max_mags)
+		tot_occ_rates += numpy.bincount(sources,weights=gr_rates,minlength=n_sources)
+		numpy.maximum.at(max_mags,sources,gr_max_mags)
+
+		sources,min_vals,bin_sizes,rates,offsets = self._incremental_arrays()
+		n_rates = numpy.diff(offsets)
+		# MFDs without rates are left out of reduceat, which
+		# would return the first rate of the next MFD for them
+		inc_rates = numpy.zeros(len(sources))
+		not_empty = n_rates > 0
+		if not_empty.any():
+			inc_rates[not_empty] = numpy.add.reduceat(rates,offsets[:-1][not_empty])
+		tot_occ_rates += numpy.bincount(sources,weights=inc_rates,minlength=n_sources)
+		numpy.maximum.at(max_mags,sources,min_vals + (n_rates - 1) * bin_sizes)
+
+		max_mags[numpy.isinf(max_mags)] = numpy.nan
+		return max_mags,tot_occ_rates
+
+	def get_magnitude_range(self):
+		"""
+		Return minimum and maximum magnitude of all the MFDs.
+		Raise RuntimeError if there is no MFD.
+		"""
+		if not len(self):
+			raise RuntimeError('No source has a MFD')
+		_,_,_,min_mags,max_mags = self._gr_arrays()
+		_,min_vals,bin_sizes,_,offsets = self._incremental_arrays()
+		inc_max_mags = min_vals + (numpy.diff(offsets) - 1) * bin_sizes
+		return (numpy.concatenate((min_mags,min_vals)).min(),
+			numpy.concatenate((max_mags,inc_max_mags)).max())
+
+	def get_mag_edges(self,bin_width):
+		"""
+		Return edges of the magnitude bins of the given width
+		covering all the MFDs. Bins are aligned on multiples of
+		bin_width, the last one containing the maximum magnitude.
+		Raise RuntimeError if there is no MFD.
+		"""
+		min_mag, max_mag = self.get_magnitude_range()
+		first_bin = int(numpy.floor(round(min_mag / bin_width,6)))
+		last_bin = int(numpy.floor(round(max_mag / bin_width,6)))
+		return numpy.arange(first_bin,last_bin + 2) * bin_width
+
+	def get_binned_rates(self,n_sources,mag_edges):
+		"""
+		Return the occurrence rates of each source in the magnitude
+		bins with the given edges, as a (sources x bins) array.
+		Gutenberg-Richter rates are integrated over each bin, rates
+		of incremental MFDs go to the bin containing their magnitude.
+		"""
+		mag_edges = numpy.asarray(mag_edges,dtype=float)
+		table = numpy.zeros((n_sources,len(mag_edges) - 1))
+
+		# rate between the bin edges, clipped to the magnitude range of each MFD
+		sources,a_vals,b_vals,min_mags,max_mags = self._gr_arrays()
+		lower = numpy.clip(mag_edges[:-1],min_mags[:,None],max_mags[:,None])
+		upper = numpy.clip(mag_edges[1:],min_mags[:,None],max_mags[:,None])
+		gr_rates = 10.0 ** (a_vals[:,None] - b_vals[:,None] * lower) - \
+			10.0 ** (a_vals[:,None] - b_vals[:,None] * upper)
+		numpy.add.at(table,sources,gr_rates)
+
+		# magnitude of each incremental rate, and its source
+		sources,min_vals,bin_sizes,rates,offsets = self._incremental_arrays()
+		n_rates = numpy.diff(offsets)
+		mfds = numpy.repeat(numpy.arange(len(sources)),n_rates)
+		positions = numpy.arange(len(rates)) - offsets[:-1][mfds]
+		mags = min_vals[mfds] + positions * bin_sizes[mfds]
+		bins = numpy.searchsorted(mag_edges,mags,side='right') - 1
+		inside = (bins >= 0) & (bins < len(mag_edges) - 1)
+		numpy.add.at(table,(sources[mfds][inside],bins[inside]),rates[inside])
+
+		return table
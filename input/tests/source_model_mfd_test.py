@@ -0,0 +1,62 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# NRML is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# NRML is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with NRML.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy
+from numpy.testing import assert_allclose
+
+from source_model_mfd import MFDCollection
+
+
+class AnMFDCollectionShould(unittest.TestCase):
+
+    def setUp(self):
+        # source 0: two incremental MFDs, magnitudes 5.0, 5.5 and 5.5, 6.0
+        # source 1: truncated GR between 5.0 and 6.0 and incremental
+        # MFD at magnitude 6.5
+        # source 2: no MFD
+        self.mfds = MFDCollection()
+        self.mfds.add_incremental(0, 5.0, 0.5, [0.2, 0.1])
+        self.mfds.add_incremental(0, 5.5, 0.5, [0.04, 0.01])
+        self.mfds.add_truncated_gr(1, 4.0, 1.0, 5.0, 6.0)
+        self.mfds.add_incremental(1, 6.5, 0.5, [0.002])
+
+    def test_sum_the_mfds_of_each_source(self):
+        max_mags, tot_occ_rates = self.mfds.get_totals(3)
+
+        assert_allclose([6.0, 6.5], max_mags[:2])
+        self.assertTrue(numpy.isnan(max_mags[2]))
+        # GR rate is 10 ** (4 - 5) - 10 ** (4 - 6)
+        assert_allclose([0.35, 0.09 + 0.002, 0.0], tot_occ_rates)
+
+    def test_align_bin_edges_on_multiples_of_the_bin_width(self):
+        assert_allclose([5.0, 5.5, 6.0, 6.5, 7.0],
+                        self.mfds.get_mag_edges(0.5))
+
+        mag_edges = self.mfds.get_mag_edges(0.1)
+        self.assertEqual(17, len(mag_edges))
+        assert_allclose([5.0, 6.6], mag_edges[[0, -1]])
+
+    def test_bin_the_rates_of_each_source(self):
+        table = self.mfds.get_binned_rates(3, [5.0, 5.5, 6.0, 6.5, 7.0])
+
+        gr_rates = [0.1 - 10 ** -1.5, 10 ** -1.5 - 0.01, 0.0, 0.0]
+        assert_allclose([[0.2, 0.1 + 0.04, 0.01, 0.0],
+                         numpy.add(gr_rates, [0.0, 0.0, 0.0, 0.002]),
+                         [0.0, 0.0, 0.0, 0.0]], table, atol=1e-12)
+
+    def test_refuse_bin_edges_without_mfds(self):
+        self.assertRaises(RuntimeError, MFDCollection().get_mag_edges, 0.1)
+
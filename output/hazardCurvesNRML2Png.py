@@ -2,6 +2,9 @@
 
 """
 Reads hazard curves files in NRML format and plot them using Matplotlib.
+With --summary, instead of one figure per site, mean, median and
+percentile curves of all the sites, and the density of all the
+curves, are plotted in a few figures.
 Required libraries are:
 - lxml
 - numpy
@@ -10,13 +13,15 @@ Required libraries are:
 
 import sys
 import argparse
-from lxml import etree
+import multiprocessing
+from array import array
 import numpy
-import matplotlib.pyplot as plt
-import pylab
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import nrml_reader
 
-xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
-xmlGML = '{http://www.opengis.net/gml}'
+# number of curves sent at once to a worker process
+CHUNK_SIZE = 500
 
 def set_up_arg_parser():
     """
@@ -27,65 +32,223 @@ def set_up_arg_parser():
                     'To run just type: python hazardCurvesNRML2Png.py --hazard-curves-file=/PATH/HAZARD_CURVES_FILE_NAME.xml')
     parser.add_argument('--hazard-curves-file',help='path to NRML hazard curves file',default=None)
     parser.add_argument('--ff',help='file format (eg. eps, png, jpg)',default='png')
+    parser.add_argument('--processes',help='number of processes rendering the curves',
+                    type=int,default=multiprocessing.cpu_count())
+    parser.add_argument('--summary',help='plot statistics of all the curves instead of'\
+                    ' one figure per site',action='store_true',default=False)
+    parser.add_argument('--percentiles',help='comma separated percentiles plotted in summary mode',
+                    default='5,16,50,84,95')
     return parser
 
-def parse_and_print_hazard_curves(hazard_curves_file,file_format):
+def parse_hazard_curves(hazard_curves_file):
+    """
+    Parse NRML hazard curves file, and return packed arrays:
+    site longitudes and latitudes, for each site the index
+    of its IMLs in the list of distinct IML arrays, the PoEs
+    of all the curves one after the other and the offset
+    of each curve in them.
+    """
+    lons = array('d')
+    lats = array('d')
+    imls_ids = array('l')
+    poes = array('d')
+    offsets = array('l',[0])
+    imls_list = []
+
+    for node in nrml_reader.read_hazard_curves(hazard_curves_file):
+        if not imls_list or imls_list[-1] is not node.imls:
+            imls_list.append(node.imls)
+        lons.append(node.lon)
+        lats.append(node.lat)
+        imls_ids.append(len(imls_list) - 1)
+        poes.fromstring(node.poes.tostring())
+        offsets.append(len(poes))
+
+    return (numpy.frombuffer(lons),numpy.frombuffer(lats),
+            numpy.frombuffer(imls_ids,dtype=numpy.dtype('l')),imls_list,
+            numpy.frombuffer(poes),numpy.frombuffer(offsets,dtype=numpy.dtype('l')))
+
+def parse_and_print_hazard_curves(hazard_curves_file,file_format,processes=1):
     """
     Parse NRML hazard curves file. Plot each curve in a .PNG figure. 
     """
-    parse_args = dict(source=hazard_curves_file)
-    idx = 0
-    hc_list = []
-    min_poes = +1e10
-    max_poes = -1e10
-    for _, element in etree.iterparse(**parse_args):
-
-        if element.tag == '%sIML' % xmlNRML:
-            imls = numpy.array(element.text.split(),dtype=float)
-        if element.tag == '%sHCNode' % xmlNRML:
-            lon,lat,poes = parse_hazard_curve(element)
-            hc_list.append({'idx':idx,'lon':lon,'lat':lat,'imls':imls,'poes':poes})
-            min_poes = min(min_poes,min(poes))
-            max_poes = max(max_poes,max(poes))
-            idx += 1
+    lons,lats,imls_ids,imls_list,poes,offsets = parse_hazard_curves(hazard_curves_file)
+
+    if len(poes) == 0:
+        return
+
+    min_poes = poes.min()
+    max_poes = poes.max()
 
     if min_poes < 1e-20:
         min_poes = 1.0e-6 
 
-    for hc in hc_list:
-        plot_curve(hc['idx'],hc['lon'],hc['lat'],
-                hc['imls'],hc['poes'],file_format,[min_poes,max_poes])
-
-def parse_hazard_curve(element):
-    """
-    Parse hazard curve node element, and return
-    longitude, latitude, and probabilities of
-    exceedance.
-    """ 
-    for e in element.iter():
-        if e.tag == '%spos' % xmlGML:
-            coords = str(e.text).split()
-            lon = float(coords[0])
-            lat = float(coords[1])
-        if e.tag == '%spoE' % xmlNRML:
-            poes = numpy.array(e.text.split(),dtype=float)
-    return lon,lat,poes
-
-def plot_curve(idx,lon,lat,imls,poes,file_format,mimx):
-    """
-    Plot curve using Matplotlib and save to .PNG file.
-    """
-    plt.loglog(imls,poes)
-    plt.xlabel('Intensity measure levels')
-    plt.ylabel('Probability of exceedance')
-    plt.grid(True)
-    plt.ylim(mimx)
-    print mimx
-    
-    filename = '%03d_%.2f_%.2f.%s' % (idx,lon,lat,file_format)
-    plt.savefig(filename, dpi=100)
-    plt.clf()
-    print 'saved hazard curve to file: %s' % filename
+    # curves are sent to the workers in chunks of
+    # (idx, lon, lat, index of imls, poes)
+    chunks = ([(idx,lons[idx],lats[idx],imls_ids[idx],poes[offsets[idx]:offsets[idx + 1]])
+               for idx in xrange(start,min(start + CHUNK_SIZE,len(lons)))]
+              for start in xrange(0,len(lons),CHUNK_SIZE))
+    init_args = (imls_list,file_format,[min_poes,max_poes])
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes,init_plotter,init_args)
+        for _ in pool.imap_unordered(plot_curves,chunks):
+            pass
+        pool.close()
+        pool.join()
+    else:
+        init_plotter(*init_args)
+        for chunk in chunks:
+            plot_curves(chunk)
+
+class CurvePlotter(object):
+    """
+    Plot hazard curves with the Agg backend. One figure and
+    one line are created, and only the data of the line are
+    updated from a curve to the next.
+    """
+
+    def __init__(self,mimx):
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(111)
+        self.axes.set_xscale('log')
+        self.axes.set_yscale('log')
+        self.axes.set_xlabel('Intensity measure levels')
+        self.axes.set_ylabel('Probability of exceedance')
+        self.axes.grid(True)
+        self.line, = self.axes.plot([],[])
+        self.axes.set_ylim(mimx)
+
+    def plot(self,imls,poes,filename):
+        """
+        Plot curve and save it to file.
+        """
+        self.line.set_data(imls,poes)
+        self.axes.relim()
+        self.axes.autoscale_view(scaley=False)
+        self.figure.savefig(filename,dpi=100)
+
+# plotter and plot settings of the current process,
+# set by init_plotter
+_plotter = None
+_imls_list = None
+_file_format = None
+
+def init_plotter(imls_list,file_format,mimx):
+    """
+    Create the plotter of the current process.
+    """
+    global _plotter,_imls_list,_file_format
+    _plotter = CurvePlotter(mimx)
+    _imls_list = imls_list
+    _file_format = file_format
+
+def plot_curves(chunk):
+    """
+    Plot each curve of a chunk and save it to file.
+    """
+    for idx,lon,lat,imls_id,poes in chunk:
+        filename = '%03d_%.2f_%.2f.%s' % (idx,lon,lat,_file_format)
+        _plotter.plot(_imls_list[imls_id],poes,filename)
+        print 'saved hazard curve to file: %s' % filename
+
+def get_poes_matrix(imls_ids,poes,offsets,imls_id,n_imls):
+    """
+    Return the PoEs of the sites sharing the IMLs of index
+    imls_id as a matrix (sites x IMLs).
+    """
+    sites = numpy.flatnonzero(imls_ids == imls_id)
+    return poes[offsets[sites][:,numpy.newaxis] + numpy.arange(n_imls)]
+
+def plot_summary(imls,poes_matrix,percentiles,filename):
+    """
+    Plot mean, median and percentile curves of all the sites,
+    filling the envelope between the lowest and highest percentile.
+    """
+    mean = poes_matrix.mean(axis=0)
+    median = numpy.median(poes_matrix,axis=0)
+    quantiles = numpy.percentile(poes_matrix,percentiles,axis=0)
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.set_xscale('log')
+    axes.set_yscale('log',nonposy='clip')
+    axes.fill_between(imls,quantiles[0],quantiles[-1],color='0.85',
+        label='%s-%s percentiles' % (percentiles[0],percentiles[-1]))
+    for percentile,quantile in zip(percentiles,quantiles):
+        if percentile != 50:
+            axes.plot(imls,quantile,'k--',linewidth=0.5)
+    axes.plot(imls,median,'k-',label='median')
+    axes.plot(imls,mean,'r-',label='mean')
+    axes.set_xlabel('Intensity measure levels')
+    axes.set_ylabel('Probability of exceedance')
+    axes.set_title('%s sites' % len(poes_matrix))
+    axes.grid(True)
+    axes.legend(loc='lower left')
+    figure.savefig(filename,dpi=100)
+    print 'saved hazard curves summary to file: %s' % filename
+
+def plot_density(imls,poes_matrix,filename,n_bins=50):
+    """
+    Plot the number of curves crossing each (IML, PoE) cell,
+    with PoE bins evenly spaced in log scale. Nothing is plotted
+    when no PoE is positive.
+    """
+    positive = poes_matrix > 0
+    if not positive.any():
+        print 'no positive PoE, hazard curves density not plotted: %s' % filename
+        return
+    log_poes = numpy.log10(poes_matrix[positive])
+    lo,hi = log_poes.min(),log_poes.max()
+    if hi == lo:
+        hi = lo + 1.0
+
+    # column of every positive PoE, and its PoE bin
+    n_imls = len(imls)
+    columns = numpy.nonzero(positive)[1]
+    bins = numpy.minimum(((log_poes - lo) / (hi - lo) * n_bins).astype(int),n_bins - 1)
+    counts = numpy.bincount(bins * n_imls + columns,
+        minlength=n_bins * n_imls).reshape(n_bins,n_imls)
+
+    # cell edges, half way between IMLs in log scale
+    log_imls = numpy.log10(imls)
+    steps = numpy.diff(log_imls) if n_imls > 1 else numpy.array([1.0])
+    x_edges = 10 ** numpy.concatenate(([log_imls[0] - steps[0] / 2],
+        log_imls[:-1] + steps / 2,[log_imls[-1] + steps[-1] / 2]))
+    y_edges = 10 ** numpy.linspace(lo,hi,n_bins + 1)
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    mesh = axes.pcolormesh(x_edges,y_edges,
+        numpy.ma.masked_equal(counts,0),cmap='viridis')
+    axes.set_xscale('log')
+    axes.set_yscale('log')
+    axes.set_xlim(x_edges[0],x_edges[-1])
+    axes.set_ylim(y_edges[0],y_edges[-1])
+    axes.set_xlabel('Intensity measure levels')
+    axes.set_ylabel('Probability of exceedance')
+    figure.colorbar(mesh).set_label('Number of sites')
+    figure.savefig(filename,dpi=100)
+    print 'saved hazard curves density to file: %s' % filename
+
+def summarize_hazard_curves(hazard_curves_file,file_format,percentiles):
+    """
+    Parse NRML hazard curves file. Plot statistics and density of the
+    curves, one figure each for every set of IMLs in the file.
+    """
+    _,_,imls_ids,imls_list,poes,offsets = parse_hazard_curves(hazard_curves_file)
+    percentiles = sorted(float(p) for p in percentiles.split(','))
+
+    for imls_id,imls in enumerate(imls_list):
+        poes_matrix = get_poes_matrix(imls_ids,poes,offsets,imls_id,len(imls))
+        suffix = '_%s' % imls_id if len(imls_list) > 1 else ''
+        plot_summary(imls,poes_matrix,percentiles,
+            'hazard_curves_summary%s.%s' % (suffix,file_format))
+        plot_density(imls,poes_matrix,
+            'hazard_curves_density%s.%s' % (suffix,file_format))
 
 def main(argv):
     """
@@ -94,10 +257,14 @@ def main(argv):
     parser = set_up_arg_parser()
     args = parser.parse_args()
 
-    if args.hazard_curves_file:
+    if args.hazard_curves_file and args.summary:
+        summarize_hazard_curves(
+                args.hazard_curves_file,
+                args.ff,args.percentiles)
+    elif args.hazard_curves_file:
         parse_and_print_hazard_curves(
                 args.hazard_curves_file,
-                args.ff)
+                args.ff,args.processes)
     else:
         parser.print_help()
 
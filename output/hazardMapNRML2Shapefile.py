@@ -3,22 +3,27 @@
 """
 Reads hazard map in NRML format and converts it to shapefile.
 Supports NRML format 0.3.
+Parsed data can also be saved to (and later loaded from) a .npz
+file with longitude, latitude and IML arrays, which is much faster
+to read than the NRML file.
+Many files (e.g. one per PoE and logic tree realization) can be
+converted at once, in parallel, with --batch or --manifest.
 Required libraries are:
 - lxml
+- numpy
 - pyshp
 """
 
+import os
 import sys
+import glob
 import math
+import time
 import argparse
+import multiprocessing
+import numpy
 import shapefile
-from lxml import etree
-
-xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
-xmlGML = '{http://www.opengis.net/gml}'
-
-w = shapefile.Writer(shapefile.POINT)
-w.field('VALUE','N',10,5)
+import nrml_reader
 
 def set_up_arg_parser():
 	"""
@@ -26,53 +31,134 @@ def set_up_arg_parser():
 	"""
 	parser = argparse.ArgumentParser(description='Convert NRML format hazard map file to shapefile.'\
 					'To run just type: python hazardMapNRML2Shapefile.py --hazard-map-file=/PATH/HAZARD_MAP_FILE_NAME.xml')
-	parser.add_argument('--hazard-map-file',help='path to NRML hazard map file',default=None)
+	parser.add_argument('--hazard-map-file',help='path to NRML hazard map file'\
+					' (or to .npz file saved with --npz)',default=None)
+	parser.add_argument('--npz',help='save longitudes, latitudes and IMLs to .npz file'\
+					' next to the shapefile',action='store_true',default=False)
+	parser.add_argument('--batch',help='convert all the files matching a glob pattern'\
+					' (e.g. "results/hazard-map-*.xml")',default=None)
+	parser.add_argument('--manifest',help='convert all the files listed (one per line)'\
+					' in a manifest file',default=None)
+	parser.add_argument('--processes',help='number of worker processes used in batch mode',
+					type=int,default=multiprocessing.cpu_count())
 	return parser
 
 def parse_hazard_map_file(hazard_map_file):
 	"""
-	Parse NRML hazard map file. 
+	Parse NRML hazard map file. Return longitudes,
+	latitudes and IMLs as numpy arrays.
 	"""
-	parse_args = dict(source=hazard_map_file)
+	# one row (lon, lat, IML) per node, the table
+	# doubles its size every time it gets full
+	table = numpy.empty((1024,3))
+	size = 0
+
+	for node in nrml_reader.read_hazard_map(hazard_map_file):
+		if size == table.shape[0]:
+			table.resize((2 * size,3),refcheck=False)
+		table[size] = node
+		size += 1
+
+	table.resize((size,3),refcheck=False)
+	
+	return table[:,0],table[:,1],table[:,2]
 
-	lons = []
-	lats = []
-	data = []
+def save_hazard_map_arrays(lons,lats,data,file_name):
+	"""
+	Save hazard map data to .npz file.
+	"""
+	numpy.savez(file_name,lon=lons,lat=lats,iml=data)
 
-	for _, element in etree.iterparse(**parse_args):
+	print 'Hazard map arrays saved to: %s.npz' % file_name
 
-		if element.tag == '%sHMNode' % xmlNRML:
-			lon,lat,value = parse_hazard_map_node(element)
-			lons.append(lon)
-			lats.append(lat)
-			data.append(value)
-	
-	return lons,lats,data
-
-def parse_hazard_map_node(element):
+def load_hazard_map_arrays(npz_file):
 	"""
-	Parse Hazard Map Node element.
+	Load hazard map data saved with save_hazard_map_arrays.
 	"""
-	for e in element.iter():
-		if e.tag == '%spos' % xmlGML:
-			coords = str(e.text).split()
-			lon = float(coords[0])
-			lat = float(coords[1])
-		if e.tag == '%sIML' % xmlNRML:
-			value = float(e.text)
-	return lon,lat,value
+	arrays = numpy.load(npz_file)
+	return arrays['lon'],arrays['lat'],arrays['iml']
 
 def serialize_data_to_shapefile(lons,lats,data,file_name):
 	"""
 	Serialize hazard map data to shapefile.
 	"""
+	w = shapefile.Writer(shapefile.POINT)
+	w.field('VALUE','N',10,5)
 	for i in range(0,len(data)):
 		w.point(lons[i],lats[i],0,0)
 		w.record(round(data[i],5))
-	w.save(file_name)
+	# pyshp drops the extension, give one so that dots in file_name are kept
+	w.save(file_name + '.shp')
 
 	print 'Shapefile saved to: %s.shp' % file_name
 
+def convert_hazard_map_file(hazard_map_file,npz=False):
+	"""
+	Convert a hazard map (NRML or .npz) file to shapefile, saved next
+	to it. Return the number of points.
+	"""
+	file_name = os.path.splitext(hazard_map_file)[0]
+	if hazard_map_file.endswith('.npz'):
+		lons,lats,data = load_hazard_map_arrays(hazard_map_file)
+	else:
+		lons,lats,data = parse_hazard_map_file(hazard_map_file)
+	if npz:
+		save_hazard_map_arrays(lons,lats,data,file_name)
+	serialize_data_to_shapefile(lons,lats,data,file_name)
+	return len(data)
+
+def convert_task(task):
+	"""
+	Convert a file in a worker process. Return file name, number
+	of points, time spent and error message (None on success).
+	"""
+	hazard_map_file,npz = task
+	start = time.time()
+	try:
+		points = convert_hazard_map_file(hazard_map_file,npz)
+		return hazard_map_file,points,time.time() - start,None
+	except Exception, e:
+		return hazard_map_file,0,time.time() - start,'%s: %s' % (e.__class__.__name__,e)
+
+def get_batch_files(pattern=None,manifest=None):
+	"""
+	Return the files matching a glob pattern, and the files listed in
+	a manifest. Relative paths in the manifest are relative to its folder.
+	"""
+	files = []
+	if pattern:
+		files.extend(sorted(glob.glob(pattern)))
+	if manifest:
+		with open(manifest) as f:
+			for line in f:
+				if line.strip():
+					files.append(os.path.join(os.path.dirname(manifest),line.strip()))
+	return files
+
+def convert_batch(files,npz,processes):
+	"""
+	Convert files in parallel, each in its own worker with its own
+	shapefile writer, and print a summary of throughput and failures.
+	"""
+	start = time.time()
+	pool = multiprocessing.Pool(processes)
+	results = pool.map(convert_task,[(f,npz) for f in files])
+	pool.close()
+	pool.join()
+	elapsed = max(time.time() - start,1e-6)
+
+	failures = [(f,error) for f,_,_,error in results if error is not None]
+	points = sum(p for _,p,_,_ in results)
+	converted = len(results) - len(failures)
+
+	print 'Converted %d of %d files (%d points) in %.1f s using %d processes' % \
+		(converted,len(results),points,elapsed,processes)
+	print 'Throughput: %.2f files/s, %.0f points/s' % (converted / elapsed,points / elapsed)
+	for f,error in failures:
+		print 'FAILED %s: %s' % (f,error)
+
+	return failures
+
 def main(argv):
 	"""
 	Parse command line argument and performs requested action.
@@ -80,9 +166,16 @@ def main(argv):
 	parser = set_up_arg_parser()
 	args = parser.parse_args()
 
-	if args.hazard_map_file:
-		lons,lats,data = parse_hazard_map_file(args.hazard_map_file)
-		serialize_data_to_shapefile(lons,lats,data,args.hazard_map_file.split('.')[0])
+	if args.batch or args.manifest:
+		files = get_batch_files(args.batch,args.manifest)
+		if not files:
+			print 'No hazard map file to convert'
+			sys.exit(1)
+		failures = convert_batch(files,args.npz,args.processes)
+		if failures:
+			sys.exit(1)
+	elif args.hazard_map_file:
+		convert_hazard_map_file(args.hazard_map_file,args.npz)
 	else:
 		parser.print_help()
 
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+"""
+Read loss (and loss-ratio) curves files in NRML format and aggregate
+them into a few curves, for the whole portfolio, per taxonomy or per
+cell of a regular grid, saved to a .CSV file.
+Each curve is interpolated on a common grid of losses, and only running
+sums (and, for quantiles, histograms of the PoEs) are kept for each group,
+so memory does not depend on the number of assets.
+For each group and loss the file contains the mean probability of
+exceedance, the expected number of assets exceeding the loss, and the
+requested quantiles of the probabilities of exceedance.
+Required libraries are:
+- lxml
+- numpy
+"""
+
+import sys
+import csv
+import argparse
+import numpy
+import nrml_reader
+
+GROUP_BY = ('portfolio', 'taxonomy', 'cell')
+
+# PoEs below POE_MIN fall in the first bin of the quantile histograms,
+# the others in QUANTILE_BINS bins evenly spaced in log scale
+POE_MIN = 1e-8
+QUANTILE_BINS = 200
+
+def set_up_arg_parser():
+	"""
+	Set up command line parser.
+	"""
+	parser = argparse.ArgumentParser(description='Aggregate loss (loss-ratio) curves from NRML file '\
+					'and save the aggregate curves to a .CSV file.'\
+					'To run just type: python lossCurvesNRML2Aggregate.py --loss-curves-file=/PATH/LOSS_CURVES_FILE_NAME.xml')
+	parser.add_argument('--loss-curves-file',help='path to NRML loss curves file',default=None)
+	parser.add_argument('--group-by',help='aggregate curves for the whole portfolio, '\
+					'per taxonomy or per grid cell',choices=GROUP_BY,default='portfolio')
+	parser.add_argument('--exposure-file',help='path to NRML exposure file '\
+					'(required to group by taxonomy)',default=None)
+	parser.add_argument('--cell-size',help='size in degrees of the grid cells',
+					type=float,default=1.0)
+	parser.add_argument('--grid-size',help='number of losses in the common loss grid',
+					type=int,default=100)
+	parser.add_argument('--max-loss',help='maximum loss of the common loss grid '\
+					'(if not given, read from the file)',type=float,default=None)
+	parser.add_argument('--quantiles',help='comma separated quantiles of the PoEs, eg. 0.05,0.5,0.95',
+					default=None)
+	parser.add_argument('--output',help='path to output .CSV file',
+					default='aggregate_loss_curves.csv')
+	return parser
+
+class CurveAccumulator(object):
+	"""
+	Accumulate curves interpolated on a common loss grid: number
+	of curves and sum of PoEs, and if quantiles are required,
+	the histogram of the PoEs at each loss.
+	"""
+
+	def __init__(self,grid,quantiles=False):
+		self.grid = grid
+		self.count = 0
+		self.poes_sum = numpy.zeros(len(grid))
+		self.histogram = None
+		if quantiles:
+			self.histogram = numpy.zeros((QUANTILE_BINS + 1,len(grid)),dtype=int)
+
+	def add(self,loss,poe):
+		"""
+		Interpolate curve on the grid and add it. PoEs are constant
+		below the first loss of the curve and zero above the last.
+		"""
+		poes = numpy.interp(self.grid,loss,poe,left=poe[0],right=0.0)
+		self.count += 1
+		self.poes_sum += poes
+		if self.histogram is not None:
+			self.histogram[get_poe_bins(poes),numpy.arange(len(poes))] += 1
+
+	def mean(self):
+		"""
+		Return the mean PoE at each loss.
+		"""
+		return self.poes_sum / self.count
+
+	def quantile(self,q):
+		"""
+		Return the q quantile of the PoEs at each loss,
+		approximated with the center of its histogram bin.
+		"""
+		cumulative = self.histogram.cumsum(axis=0)
+		bins = (cumulative < q * self.count).sum(axis=0)
+		return get_bin_centers()[numpy.minimum(bins,QUANTILE_BINS)]
+
+def get_bin_edges():
+	"""
+	Return the edges of the log spaced PoE bins.
+	"""
+	return numpy.logspace(numpy.log10(POE_MIN),0.0,QUANTILE_BINS + 1)
+
+def get_bin_centers():
+	"""
+	Return the value of each PoE bin: zero for the first bin,
+	the geometric center for the others.
+	"""
+	edges = get_bin_edges()
+	return numpy.concatenate(([0.0],numpy.sqrt(edges[:-1] * edges[1:])))
+
+def get_poe_bins(poes):
+	"""
+	Return the histogram bin of each PoE.
+	"""
+	return numpy.minimum(numpy.searchsorted(get_bin_edges(),poes,side='right'),
+		QUANTILE_BINS)
+
+def get_max_loss(loss_curves_file):
+	"""
+	Return the maximum loss of all the curves in loss curves file.
+	"""
+	max_loss = 0.0
+	for asset in nrml_reader.read_loss_curves(loss_curves_file):
+		max_loss = max(max_loss,asset.loss.max())
+	return max_loss
+
+def get_group_key(group_by,cell_size=1.0,taxonomies=None):
+	"""
+	Return a function giving the group of a LossCurveAsset.
+	"""
+	if group_by == 'portfolio':
+		return lambda asset: 'portfolio'
+	elif group_by == 'taxonomy':
+		if taxonomies is None:
+			raise RuntimeError('Exposure file is required to group by taxonomy')
+		return lambda asset: taxonomies.get(asset.asset_id) or 'unknown'
+	elif group_by == 'cell':
+		return lambda asset: '%s_%s' % (
+			numpy.floor(asset.lon / cell_size) * cell_size,
+			numpy.floor(asset.lat / cell_size) * cell_size)
+	raise RuntimeError('Unknown grouping: %s' % group_by)
+
+def aggregate_loss_curves(loss_curves_file,grid,group_key,quantiles=False):
+	"""
+	Parse NRML loss curves file and return a dictionary
+	of CurveAccumulator, one for each group.
+	"""
+	groups = {}
+	for asset in nrml_reader.read_loss_curves(loss_curves_file):
+		key = group_key(asset)
+		if key not in groups:
+			groups[key] = CurveAccumulator(grid,quantiles)
+		groups[key].add(asset.loss,asset.poe)
+	return groups
+
+def write_aggregate_curves(groups,quantiles,output):
+	"""
+	Write aggregate curves to .CSV file, one row for each group and loss.
+	"""
+	with open(output,'wb') as f:
+		writer = csv.writer(f)
+		writer.writerow(['group','loss','mean_poe','expected_assets'] +
+			['quantile_%s' % q for q in quantiles])
+		for key in sorted(groups):
+			group = groups[key]
+			columns = [group.grid,group.mean(),group.poes_sum] + \
+				[group.quantile(q) for q in quantiles]
+			for row in zip(*columns):
+				writer.writerow([key] + ['%.6g' % v for v in row])
+	print 'saved %s aggregate curves to file: %s' % (len(groups),output)
+
+def main(argv):
+	"""
+	Parse command line argument and performs requested action.
+	"""
+	parser = set_up_arg_parser()
+	args = parser.parse_args()
+
+	if not args.loss_curves_file:
+		parser.print_help()
+		return
+
+	taxonomies = None
+	if args.exposure_file:
+		taxonomies = dict(nrml_reader.read_exposure_taxonomies(args.exposure_file))
+	group_key = get_group_key(args.group_by,args.cell_size,taxonomies)
+
+	quantiles = []
+	if args.quantiles:
+		quantiles = [float(q) for q in args.quantiles.split(',')]
+
+	max_loss = args.max_loss
+	if max_loss is None:
+		max_loss = get_max_loss(args.loss_curves_file)
+	grid = numpy.linspace(0.0,max_loss,args.grid_size)
+
+	groups = aggregate_loss_curves(args.loss_curves_file,grid,group_key,bool(quantiles))
+	write_aggregate_curves(groups,quantiles,args.output)
+
+if __name__=='__main__':
+
+	main(sys.argv)
@@ -2,6 +2,10 @@
 
 """
 Read loss (and loss-ratio) curves files in NRML format and plot them using Matplotlib.
+Curves are parsed one asset at a time and passed through a bounded
+queue to a pool of processes rendering them with the Agg backend,
+so memory does not grow with the size of the file. Assets can be
+selected by ID, by bounding box, or sampled.
 Required libraries are:
 - lxml
 - numpy
@@ -9,13 +13,21 @@ Required libraries are:
 """
 
 import sys
+import Queue
 import argparse
-from lxml import etree
-import numpy
-import matplotlib.pyplot as plt
+import multiprocessing
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import nrml_reader
 
-xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
-xmlGML = '{http://www.opengis.net/gml}'
+# maximum number of curves waiting in the queue to be plotted
+QUEUE_SIZE = 1000
+
+# number of parsed assets between two progress reports
+PROGRESS_STEP = 1000
+
+# seconds waited for room in the queue before checking the workers are alive
+PUT_TIMEOUT = 5
 
 def set_up_arg_parser():
 	"""
@@ -25,55 +37,181 @@ def set_up_arg_parser():
 					'Each curve is saved to a .PNG file.'\
 					'To run just type: python lossCurvesNRML2Png.py --loss-curves-file=/PATH/LOSS_CURVES_FILE_NAME.xml')
 	parser.add_argument('--loss-curves-file',help='path to NRML loss curves file',default=None)
+	parser.add_argument('--processes',help='number of processes rendering the curves',
+					type=int,default=multiprocessing.cpu_count())
+	parser.add_argument('--asset-ids',help='comma separated IDs of the assets to plot',default=None)
+	parser.add_argument('--bbox',help='plot only assets inside bounding box: '\
+					'min_lon,min_lat,max_lon,max_lat',default=None)
+	parser.add_argument('--sample',help='plot only one asset every SAMPLE selected assets',
+					type=positive_int,default=1)
 	return parser
 
-def parse_and_print_loss_curves(loss_curves_file):
+def positive_int(value):
+	"""
+	Parse a command line value to an integer greater than zero.
+	"""
+	try:
+		value = int(value)
+	except ValueError:
+		value = 0
+	if value < 1:
+		raise argparse.ArgumentTypeError('must be an integer greater than zero')
+	return value
+
+def get_asset_filter(asset_ids=None,bbox=None):
+	"""
+	Return a function telling if a LossCurveAsset is selected, given
+	a comma separated list of asset IDs and/or a comma separated
+	bounding box (min_lon,min_lat,max_lon,max_lat).
+	"""
+	if asset_ids is not None:
+		asset_ids = set(asset_ids.split(','))
+	if bbox is not None:
+		bbox = [float(v) for v in bbox.split(',')]
+		if len(bbox) != 4:
+			raise RuntimeError('Bounding box must be min_lon,min_lat,max_lon,max_lat')
+		min_lon,min_lat,max_lon,max_lat = bbox
+
+	def is_selected(asset):
+		if asset_ids is not None and asset.asset_id not in asset_ids:
+			return False
+		if bbox is not None and not (min_lon <= asset.lon <= max_lon and
+				min_lat <= asset.lat <= max_lat):
+			return False
+		return True
+
+	return is_selected
+
+def select_loss_curves(loss_curves_file,is_selected,sample=1,counters=None):
+	"""
+	Yield the selected assets of NRML loss curves file, one every
+	sample. If given, the counters dictionary is updated with the
+	number of parsed and selected assets.
+	"""
+	if counters is None:
+		counters = {}
+	counters['parsed'] = counters['selected'] = 0
+	for asset in nrml_reader.read_loss_curves(loss_curves_file):
+		counters['parsed'] += 1
+		if counters['parsed'] % PROGRESS_STEP == 0:
+			print 'parsed %(parsed)d assets, selected %(selected)d' % counters
+		if not is_selected(asset):
+			continue
+		counters['selected'] += 1
+		if (counters['selected'] - 1) % sample == 0:
+			yield asset
+
+def parse_and_print_loss_curves(loss_curves_file,processes=1,is_selected=None,sample=1):
 	"""
 	Parse NRML loss curves file. Plot each curve in a .PNG figure. 
+	Return the number of curves that could not be plotted.
+	"""
+	if is_selected is None:
+		is_selected = get_asset_filter()
+	counters = {}
+	assets = select_loss_curves(loss_curves_file,is_selected,sample,counters)
+
+	if processes > 1:
+		queue = multiprocessing.Queue(QUEUE_SIZE)
+		plotted = multiprocessing.Value('l',0)
+		failed = multiprocessing.Value('l',0)
+		workers = [multiprocessing.Process(target=plot_worker,args=(queue,plotted,failed))
+			for _ in range(processes)]
+		for worker in workers:
+			worker.start()
+		for asset in assets:
+			put_asset(queue,asset,workers)
+		for worker in workers:
+			put_asset(queue,None,workers)
+		for worker in workers:
+			worker.join()
+		counters['plotted'] = plotted.value
+		counters['failed'] = failed.value
+		dead = [worker for worker in workers if worker.exitcode != 0]
+		if dead:
+			raise RuntimeError('%d plotting processes died, '\
+				'some curves may not be plotted' % len(dead))
+	else:
+		plotter = LossCurvePlotter()
+		counters['plotted'] = counters['failed'] = 0
+		for asset in assets:
+			if plot_asset(plotter,asset):
+				counters['plotted'] += 1
+			else:
+				counters['failed'] += 1
+
+	print 'parsed %(parsed)d assets, selected %(selected)d, '\
+		'plotted %(plotted)d curves, failed %(failed)d' % counters
+	return counters['failed']
+
+def put_asset(queue,asset,workers):
+	"""
+	Put asset in queue, waiting for room as long as
+	at least one of the workers is alive.
+	"""
+	while True:
+		try:
+			queue.put(asset,True,PUT_TIMEOUT)
+			return
+		except Queue.Full:
+			if not any(worker.is_alive() for worker in workers):
+				raise RuntimeError('All plotting processes died')
+
+class LossCurvePlotter(object):
+	"""
+	Plot loss curves with the Agg backend. One figure and one line
+	are created, and only the data of the line are updated from
+	a curve to the next.
+	"""
+
+	def __init__(self):
+		self.figure = Figure()
+		FigureCanvasAgg(self.figure)
+		self.axes = self.figure.add_subplot(111)
+		self.axes.set_xscale('log')
+		self.axes.set_yscale('log')
+		self.axes.set_ylabel('Probability of exceedance')
+		self.axes.grid(True)
+		self.line, = self.axes.plot([],[])
+
+	def plot(self,asset):
+		"""
+		Plot curve of asset and save it to .PNG file.
+		"""
+		self.line.set_data(asset.loss,asset.poe)
+		self.axes.set_xlabel(asset.x_label)
+		self.axes.relim()
+		self.axes.autoscale_view()
+
+		filename = '%s_%s_%s.png' % (asset.asset_id,asset.lon,asset.lat)
+		self.figure.savefig(filename,dpi=100)
+		return filename
+
+def plot_asset(plotter,asset):
+	"""
+	Plot curve of asset, reporting failures.
+	Return True if the curve was plotted.
+	"""
+	try:
+		plotter.plot(asset)
+		return True
+	except Exception, e:
+		print 'FAILED asset %s: %s: %s' % (asset.asset_id,e.__class__.__name__,e)
+		return False
+
+def plot_worker(queue,plotted,failed):
+	"""
+	Plot the assets taken from queue until None is found,
+	incrementing the shared counters of plotted and failed curves.
 	"""
-	parse_args = dict(source=loss_curves_file)
-
-	for _, element in etree.iterparse(**parse_args):
-
-		if element.tag == '%sasset' % xmlNRML:
-			ID,x_label,lon,lat,loss,poe = parse_asset(element)
-			print loss, poe
-			plot_curve(ID,x_label,lon,lat,loss,poe)
-
-def parse_asset(element):
-	"""
-	Parse asset element, and return
-	longitude, latitude, losses and poes.
-	"""	
-	ID = element.get('%sid' % xmlGML)
-	for e in element.iter():
-		if e.tag == '%spos' % xmlGML:
-			coords = str(e.text).split()
-			lon = float(coords[0])
-			lat = float(coords[1])
-		if e.tag == '%slossCurve' % xmlNRML:
-			loss = numpy.array(e.find('%sloss' % xmlNRML).text.split(),dtype=float)
-			poe = numpy.array(e.find('%spoE' % xmlNRML).text.split(),dtype=float)
-			x_label = 'loss'
-		if e.tag == '%slossRatioCurve' % xmlNRML:
-			loss = numpy.array(e.find('%slossRatio' % xmlNRML).text.split(),dtype=float)
-			poe = numpy.array(e.find('%spoE' % xmlNRML).text.split(),dtype=float)
-			x_label = 'loss ratio'
-	return ID,x_label,lon,lat,loss,poe
-
-def plot_curve(ID,x_label,lon,lat,loss,poe):
-	"""
-	Plot curve using Matplotlib and save to .PNG file.
-	"""
-	plt.loglog(loss,poe)
-	plt.xlabel(x_label)
-	plt.ylabel('Probability of exceedance')
-	plt.grid(True)
-	
-	filename = '%s_%s_%s.png' % (ID,lon,lat)
-	plt.savefig(filename, dpi=100)
-	plt.clf()
-	print 'saved loss/loss-ratio curve to file: %s' % filename
+	plotter = LossCurvePlotter()
+	for asset in iter(queue.get,None):
+		if plot_asset(plotter,asset):
+			counter = plotted
+		else:
+			counter = failed
+		with counter.get_lock():
+			counter.value += 1
 
 def main(argv):
 	"""
@@ -83,7 +221,14 @@ def main(argv):
 	args = parser.parse_args()
 
 	if args.loss_curves_file:
-		parse_and_print_loss_curves(args.loss_curves_file)
+		try:
+			failed = parse_and_print_loss_curves(args.loss_curves_file,args.processes,
+				get_asset_filter(args.asset_ids,args.bbox),args.sample)
+		except RuntimeError, e:
+			print 'Error: %s' % e
+			sys.exit(1)
+		if failed:
+			sys.exit(1)
 	else:
 		parser.print_help()
 
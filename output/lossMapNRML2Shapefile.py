@@ -12,10 +12,7 @@ import sys
 import math
 import argparse
 import shapefile
-from lxml import etree
-
-xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
-xmlGML = '{http://www.opengis.net/gml}'
+import nrml_reader
 
 w = shapefile.Writer(shapefile.POINT)
 w.field('VALUE','N',20,5)
@@ -33,42 +30,19 @@ def parse_loss_map_file(loss_map_file):
 	"""
 	Parse NRML loss map file.
 	"""
-	parse_args = dict(source=loss_map_file)
-
 	lons = []
 	lats = []
 	data = []
 
-	for _, element in etree.iterparse(**parse_args):
-
-		if element.tag == '%sLMNode' % xmlNRML:
-			lon,lat,value = parse_loss_map_node(element)
-			lons.append(lon)
-			lats.append(lat)
-			data.append(value)
+	# each node loss is the total loss (sum of
+	# losses from the different assets)
+	for node in nrml_reader.read_loss_map(loss_map_file):
+		lons.append(node.lon)
+		lats.append(node.lat)
+		data.append(node.loss)
 	
 	return lons,lats,data
 
-def parse_loss_map_node(element):
-	"""
-	Parse loss map node. Return longitude
-	and latitude, and total loss (sum of
-	losses from the different assets)
-	"""
-	total_value = 0.0
-	for e in element.iter():
-		if e.tag == '%spos' % xmlGML:
-			coords = str(e.text).split()
-			lon = float(coords[0])
-			lat = float(coords[1])
-		if e.tag == '%svalue' % xmlNRML:
-			value = float(e.text)
-			total_value += value
-		if e.tag == '%smean' % xmlNRML:
-			value = float(e.text)
-			total_value += value
-	return lon,lat,total_value
-
 def serialize_data_to_shapefile(lons,lats,data,file_name):
 	"""
 	Serialize hazard map data to shapefile.
@@ -25,25 +25,27 @@ output is in ./computed_output
 """
 
 import argparse
+from array import array
 from collections import namedtuple
-from lxml import etree
 import os
 import sys
 
-from plotmap import create_map
+import numpy
+
+from plotmap import (create_map, create_map_matplotlib, create_grid_map,
+        create_grid_map_matplotlib, bin_entries)
+
+# the NRML readers are shared with the other output converters
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import nrml_reader
 
 MSG_ERROR_NO_OUTPUT_FILE = 'Error: unspecified output file\n'
 MSG_ERROR_NONEXISTENT_FILE = 'Error: nonexistent input file\n'
 OUTPUT_DIR = os.path.expanduser('~/map_creator')
 OUTPUT_DAT = 'dat'
 
-NRML_NS = '{http://openquake.org/xmlns/nrml/0.4}'
-
-NODE = '%snode' % NRML_NS
-
-POS_NODE = '{http://www.opengis.net/gml}pos'
-
-LOSS_NODE_ELEM = '%sloss' % NRML_NS
+BACKENDS = ('gmt', 'matplotlib')
 
 ENTRY = namedtuple('Entry', 'lon, lat, sum_mean')
 
@@ -83,6 +85,35 @@ def build_cmd_parser():
                         metavar='value',
                         dest='max_val')
 
+    parser.add_argument('-b', '--backend',
+                        default='gmt',
+                        choices=BACKENDS,
+                        help='draw the map with GMT (map.eps and map.pdf) '
+                             'or matplotlib (map.png and map.pdf)',
+                        dest='backend')
+
+    parser.add_argument('-g', '--grid-res',
+                        default=None,
+                        type=float,
+                        help='sum the losses on a grid of cells of this '
+                             'size (in degrees) before plotting',
+                        metavar='value',
+                        dest='grid_res')
+
+    parser.add_argument('-l', '--log-classes',
+                        action='store_true',
+                        default=False,
+                        help='color grid cells by decade between min and '
+                             'max value (matplotlib backend only)',
+                        dest='log_classes')
+
+    parser.add_argument('-d', '--export-dat',
+                        action='store_true',
+                        default=False,
+                        help='also save the loss map entries to a txt file '
+                             'in %s' % os.path.join(OUTPUT_DIR, OUTPUT_DAT),
+                        dest='export_dat')
+
     parser.add_argument('-v', '--version',
                         action='version',
                         version="%(prog)s 0.0.1")
@@ -104,37 +135,54 @@ def create_output_folders():
 
 
 def compute_map(loss_map_file_name, args):
-    output_file_name = os.path.basename(loss_map_file_name)[0:-4] + '.txt'
-    compute_map_output = os.path.join(OUTPUT_DIR, OUTPUT_DAT, output_file_name)
-    write_loss_map_entries(compute_map_output,
-            read_loss_map_entries(loss_map_file_name))
-    create_map(OUTPUT_DIR, compute_map_output,
+    entries = read_loss_map_entries(loss_map_file_name)
+
+    if args.export_dat:
+        output_file_name = os.path.basename(loss_map_file_name)[0:-4] + '.txt'
+        compute_map_output = os.path.join(OUTPUT_DIR, OUTPUT_DAT,
+                output_file_name)
+        write_loss_map_entries(compute_map_output, entries)
+
+    if args.grid_res is not None:
+        lon_edges, lat_edges, sums = bin_entries(entries.lon, entries.lat,
+                entries.sum_mean, args.grid_res)
+        if args.backend == 'matplotlib':
+            create_grid_map_matplotlib(OUTPUT_DIR, lon_edges, lat_edges,
+                    sums, args.min_val[0], args.max_val[0],
+                    args.log_classes)
+        else:
+            create_grid_map(OUTPUT_DIR, lon_edges, lat_edges, sums,
+                    args.min_val[0], args.max_val[0])
+        return
+
+    if args.backend == 'matplotlib':
+        render = create_map_matplotlib
+    else:
+        render = create_map
+    render(OUTPUT_DIR, entries.lon, entries.lat, entries.sum_mean,
             args.res[0], args.min_val[0],
             args.max_val[0])
 
 
 def read_loss_map_entries(loss_map_xml):
-    """Create loss maps entries by parsing a loss map file"""
-
-    entries = []
-
-    elem = 1
-
-    with open(loss_map_xml) as loss_file:
-        for node in etree.iterparse(loss_file):
-            if node[elem].tag == NODE:
-                lon, lat = node[elem].find('.//%s' % POS_NODE).text.split()
-
-                loss_nodes = node[elem].findall('.//%s' % LOSS_NODE_ELEM)
+    """
+    Parse a loss map file and return its entries as an
+    ENTRY of arrays of longitudes, latitudes and losses
+    """
 
-                sum_mean = 0
-                for loss_node in loss_nodes:
-                    sum_mean += float(loss_node.get('mean'))
+    lons = array('d')
+    lats = array('d')
+    sum_means = array('d')
 
-                entries.append(ENTRY(lon, lat, sum_mean))
-                node[elem].clear()
+    # lxml reads the file by path, and the reader frees
+    # each node and its preceding siblings once parsed
+    for node in nrml_reader.read_loss_map(loss_map_xml):
+        lons.append(node.lon)
+        lats.append(node.lat)
+        sum_means.append(node.loss)
 
-    return entries
+    return ENTRY(numpy.frombuffer(lons), numpy.frombuffer(lats),
+            numpy.frombuffer(sum_means))
 
 
 def write_loss_map_entries(output_filename, loss_entries):
@@ -142,13 +190,16 @@ def write_loss_map_entries(output_filename, loss_entries):
     Write loss map entries to txt file
     where every entry is in the form
     longitude, latitude, sum_mean
+    Coordinates are parsed numbers, written with repr so that
+    they keep all their digits (e.g. 10.50 is written as 10.5)
     """
 
     with open(output_filename, 'w') as out_file:
         out_file.write('x,y,value\n')
-        for entry in loss_entries:
+        for lon, lat, sum_mean in zip(loss_entries.lon.tolist(),
+                loss_entries.lat.tolist(), loss_entries.sum_mean.tolist()):
             entry_string = ','.join(
-                [entry.lon, entry.lat, str(entry.sum_mean)]) + '\n'
+                [repr(lon), repr(lat), str(sum_mean)]) + '\n'
             out_file.write(entry_string)
 
 
@@ -162,7 +213,11 @@ def main():
         if args.input_file != None:
             if os.path.exists(args.input_file[0]):
                 create_output_folders()
-                compute_map(args.input_file[0], args)
+                try:
+                    compute_map(args.input_file[0], args)
+                except RuntimeError, e:
+                    print 'Error: %s' % e
+                    sys.exit(1)
             else:
                 print MSG_ERROR_NONEXISTENT_FILE
                 parser.print_help()
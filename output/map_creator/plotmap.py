@@ -18,15 +18,101 @@
 # <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
 
 """
-TODO: Add description
+Plot loss maps, either with GMT (create_map, create_grid_map) or
+in process with matplotlib (create_map_matplotlib,
+create_grid_map_matplotlib).
 """
 
 import os
-import re
 import math
+import subprocess
 
+import numpy
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import BoundaryNorm, ListedColormap
+
+CPT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cpt'))
+MASTER_CPT = 'YlOrRd_09.cpt'
+
+
+def create_map(output_dir, lons, lats, losses, res, min_val, max_val):
+    """
+    Plot loss map with GMT: one square of size res for each site,
+    colored by decade of loss (in thousands). Save map.eps and
+    map.pdf in output_dir
+    """
+
+    lons = numpy.asarray(lons, dtype=float)
+    lats = numpy.asarray(lats, dtype=float)
+    losses = numpy.asarray(losses, dtype=float)
+
+    # Define the extension
+    ext = "%.2f/%.2f/%.2f/%.2f" % (
+        lons.min(), lons.max(), lats.min(), lats.max())
+
+    plot_map_file_name, cptf = start_gmt_map(output_dir, ext,
+        min_val, max_val)
+
+    # Plot map, sending the entries to psxy standard input
+    res = "%.2f" % res
+
+    with open(plot_map_file_name, 'ab') as plot_map_file:
+        psxy = subprocess.Popen(["psxy", "-JM", "-O", "-K", "-R" + ext,
+            "-C" + cptf, "-Ss" + res], stdin=subprocess.PIPE,
+            stdout=plot_map_file)
+        numpy.savetxt(psxy.stdin,
+            numpy.column_stack((lons, lats, losses / 1000)), fmt='%s')
+        psxy.stdin.close()
+        psxy.wait()
+
+    finish_gmt_map(output_dir, plot_map_file_name, ext, cptf)
+
+
+def create_grid_map(output_dir, lon_edges, lat_edges, sums, min_val,
+        max_val):
+    """
+    Plot a grid of losses, as returned by bin_entries, with GMT:
+    the grid is built by xyz2grd, with the cell size of the grid
+    and pixel registration, and drawn by grdimage, colored by decade
+    of loss (in thousands). Empty cells are left transparent.
+    Save map.eps and map.pdf in output_dir
+    """
+
+    ext = "%.6f/%.6f/%.6f/%.6f" % (
+        lon_edges[0], lon_edges[-1], lat_edges[0], lat_edges[-1])
+    cell_size = "%.6f/%.6f" % (lon_edges[1] - lon_edges[0],
+        lat_edges[1] - lat_edges[0])
+
+    plot_map_file_name, cptf = start_gmt_map(output_dir, ext,
+        min_val, max_val)
+
+    # Build the grid, sending the non empty cells to xyz2grd
+    grid_file_name = os.path.join(output_dir, 'map.grd')
+    lons, lats, values = get_cell_centers(lon_edges, lat_edges, sums)
+    xyz2grd = subprocess.Popen(["xyz2grd", "-G" + grid_file_name,
+        "-R" + ext, "-I" + cell_size, "-F"], stdin=subprocess.PIPE)
+    numpy.savetxt(xyz2grd.stdin,
+        numpy.column_stack((lons, lats, values / 1000)), fmt='%s')
+    xyz2grd.stdin.close()
+    xyz2grd.wait()
+
+    cmd = "grdimage %s -JM -R%s -C%s -Q -O -K >> %s" % (grid_file_name,
+        ext, cptf, plot_map_file_name)
+    os.system(cmd)
+
+    finish_gmt_map(output_dir, plot_map_file_name, ext, cptf)
+
+
+def start_gmt_map(output_dir, ext, min_val, max_val):
+    """
+    Set GMT defaults, plot the coast of region ext to map.eps and
+    create the palette of the decades between min_val and max_val.
+    Return the names of the map and of the palette files
+    """
+
+    exponents = get_exponents(min_val, max_val)
 
-def create_map(output_dir, compute_map_output, res, min_val, max_val):
     #gmtset commands
     os.system("gmtset GRID_CROSS_SIZE_PRIMARY = 0.2i")
     os.system("gmtset BASEMAP_TYPE            = PLAIN")
@@ -39,50 +125,34 @@ def create_map(output_dir, compute_map_output, res, min_val, max_val):
     os.system("gmtset ANOT_FONT               = 21")
     os.system("gmtset PS_IMAGE_FORMAT         = hex")
 
-    tmp = os.path.join(output_dir, ".tmp")
-    cmd = "minmax -m -C " + compute_map_output + " > " + tmp
-    os.system(cmd)
-    with open(tmp, 'rb') as tmp_file:
-        line = tmp_file.readline()
-        aa = re.split("\s+", line)
-
-    # Define the extension
-    ext = "%.2f/%.2f/%.2f/%.2f" % (
-        float(aa[0]), float(aa[1]), float(aa[2]), float(aa[3]))
-
     # Plotting
     plot_map_file_name = os.path.join(output_dir, 'map.eps')
     cmd = "pscoast -P -R" + ext + " -X7.0c -JM9 -Df -Na -G230 -V -K > %s" % (
         plot_map_file_name)
     os.system(cmd)
 
-    # Create grid
-    awkcmd = "gawk '{print $1, $2, $3}' " + compute_map_output
-    os.system(awkcmd)
-
     # Create cpt
-    cpt_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cpt'))
-    cptfile = os.path.join(cpt_path, "YlOrRd_09.cpt")
+    cptfile = os.path.join(CPT_DIR, MASTER_CPT)
     cptuserdir = os.path.expanduser('~/map_creator/cpt');
     cptf = os.path.join(cptuserdir, "Blues_08.cpt")
 
     if not os.path.exists(cptuserdir):
         os.makedirs(cptuserdir)
 
-    min_val = "%.2e" % int(math.log10(min_val))
-    max_val = "%.2e" % int(math.log10(max_val))
+    min_val = "%.2e" % exponents[0]
+    max_val = "%.2e" % exponents[-1]
 
     cmd = "makecpt -C" + cptfile + " -T" + min_val + "/" + max_val \
         + "/1 -Q -D255/255/255 > " + cptf
     os.system(cmd)
 
-    # Plot map
-    res = "%.2f" % res
+    return plot_map_file_name, cptf
 
-    cmd = "gawk '{print $1, $2, $3/1000}' " + compute_map_output + \
-        " | psxy -JM -O -K -R" + ext + " -C" + cptf + " -Ss" + res + \
-        "  >> %s" % plot_map_file_name
-    os.system(cmd)
+
+def finish_gmt_map(output_dir, plot_map_file_name, ext, cptf):
+    """
+    Plot scale and coast over map.eps and convert it to map.pdf
+    """
 
     cmd = "psscale -D4/-1/13c/0.3ch -N1 -O -K -Q -C" + cptf + \
         " -B::/::>> %s" % plot_map_file_name
@@ -96,3 +166,174 @@ def create_map(output_dir, compute_map_output, res, min_val, max_val):
     pdf_out_file = os.path.join(output_dir, 'map.pdf')
     cmd = "ps2pdf %s %s" % (plot_map_file_name, pdf_out_file)
     os.system(cmd)
+
+
+def get_exponents(min_val, max_val):
+    """
+    Return the exponents of the log10 decades between min_val and
+    max_val. Raise RuntimeError if they do not span at least one decade
+    """
+
+    if min_val <= 0 or max_val <= 0:
+        raise RuntimeError('min and max value must be positive')
+    exponents = numpy.arange(int(math.log10(min_val)),
+        int(math.log10(max_val)) + 1)
+    if len(exponents) < 2:
+        raise RuntimeError('min value %s and max value %s must span at '
+            'least one decade' % (min_val, max_val))
+    return exponents
+
+
+def read_cpt_colors(cpt_file):
+    """
+    Return the colors (RGB in [0, 1]) of the slices of a GMT
+    palette file, from the lowest to the highest slice
+    """
+
+    colors = []
+    with open(cpt_file) as cpt:
+        for line in cpt:
+            fields = line.split()
+            if len(fields) == 8 and not line.startswith('#'):
+                colors.append([float(c) / 255 for c in fields[1:4]])
+    return numpy.array(colors)
+
+
+def get_classes(min_val, max_val, cpt_file):
+    """
+    Return the bounds of the log10 decades between min_val and max_val,
+    and the color of each decade sampled from a GMT palette,
+    as makecpt -T<log10(min_val)>/<log10(max_val)>/1 -Q does
+    """
+
+    bounds = 10.0 ** get_exponents(min_val, max_val)
+    master = read_cpt_colors(cpt_file)
+    n_classes = len(bounds) - 1
+    positions = (numpy.arange(n_classes) + 0.5) / n_classes
+    colors = master[(positions * len(master)).astype(int)]
+    return bounds, colors
+
+
+def get_class_colormap(min_val, max_val):
+    """
+    Return colormap and norm coloring values by log10 decade
+    between min_val and max_val
+    """
+
+    bounds, colors = get_classes(min_val, max_val,
+        os.path.join(CPT_DIR, MASTER_CPT))
+    cmap = ListedColormap(colors)
+    cmap.set_under(colors[0])
+    cmap.set_over(colors[-1])
+    return cmap, BoundaryNorm(bounds, cmap.N)
+
+
+def bin_entries(lons, lats, losses, cell_size):
+    """
+    Sum losses on a regular grid of cells of cell_size degrees, aligned
+    on multiples of cell_size. Return the longitudes and latitudes of the
+    cell edges, and the (latitude x longitude) grid of the sums, masked
+    where cells contain no entries
+    """
+
+    lons = numpy.asarray(lons, dtype=float)
+    lats = numpy.asarray(lats, dtype=float)
+
+    lon_0 = numpy.floor(lons.min() / cell_size) * cell_size
+    lat_0 = numpy.floor(lats.min() / cell_size) * cell_size
+    n_lons = int((lons.max() - lon_0) // cell_size) + 1
+    n_lats = int((lats.max() - lat_0) // cell_size) + 1
+
+    columns = numpy.minimum(((lons - lon_0) // cell_size).astype(int),
+        n_lons - 1)
+    rows = numpy.minimum(((lats - lat_0) // cell_size).astype(int),
+        n_lats - 1)
+    cells = rows * n_lons + columns
+
+    shape = (n_lats, n_lons)
+    sums = numpy.bincount(cells, weights=losses,
+        minlength=n_lats * n_lons).reshape(shape)
+    counts = numpy.bincount(cells, minlength=n_lats * n_lons).reshape(shape)
+
+    lon_edges = lon_0 + cell_size * numpy.arange(n_lons + 1)
+    lat_edges = lat_0 + cell_size * numpy.arange(n_lats + 1)
+    return lon_edges, lat_edges, numpy.ma.masked_where(counts == 0, sums)
+
+
+def get_cell_centers(lon_edges, lat_edges, sums):
+    """
+    Return longitudes, latitudes and sums of the non empty cells
+    of a grid returned by bin_entries
+    """
+
+    lons, lats = numpy.meshgrid((lon_edges[:-1] + lon_edges[1:]) / 2,
+        (lat_edges[:-1] + lat_edges[1:]) / 2)
+    full = ~numpy.ma.getmaskarray(sums)
+    return lons[full], lats[full], sums.data[full]
+
+
+def create_grid_map_matplotlib(output_dir, lon_edges, lat_edges, sums,
+        min_val, max_val, log_classes=False, formats=('png', 'pdf')):
+    """
+    Plot a grid of losses, as returned by bin_entries, as an image with
+    matplotlib. Cells are colored by decade of loss (in thousands) like
+    the GMT map if log_classes is True, or on a continuous scale.
+    Save map.<format> in output_dir for each format
+    """
+
+    if log_classes:
+        cmap, norm = get_class_colormap(min_val, max_val)
+        values = sums / 1000
+        colorbar_args = dict(extend='both', spacing='uniform', format='%.0e')
+    else:
+        cmap, norm = 'YlOrRd', None
+        values = sums
+        colorbar_args = {}
+
+    figure = Figure(figsize=(21.0 / 2.54, 29.7 / 2.54))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111, aspect='equal')
+    axes.set_facecolor('0.9')
+    mesh = axes.pcolormesh(lon_edges, lat_edges, values, cmap=cmap,
+        norm=norm)
+    axes.set_xlim(lon_edges[0], lon_edges[-1])
+    axes.set_ylim(lat_edges[0], lat_edges[-1])
+    axes.grid(True)
+    figure.colorbar(mesh, orientation='horizontal', **colorbar_args)
+
+    for file_format in formats:
+        map_file_name = os.path.join(output_dir, 'map.%s' % file_format)
+        figure.savefig(map_file_name, dpi=150, bbox_inches='tight')
+
+
+def create_map_matplotlib(output_dir, lons, lats, losses, res, min_val,
+        max_val, formats=('png', 'pdf')):
+    """
+    Plot loss map with matplotlib: one square of side res (in cm)
+    for each site, colored by decade of loss (in thousands)
+    like the GMT map. Save map.<format> in output_dir for each format
+    """
+
+    lons = numpy.asarray(lons, dtype=float)
+    lats = numpy.asarray(lats, dtype=float)
+    losses = numpy.asarray(losses, dtype=float)
+
+    cmap, norm = get_class_colormap(min_val, max_val)
+
+    figure = Figure(figsize=(21.0 / 2.54, 29.7 / 2.54))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111, aspect='equal')
+    axes.set_facecolor('0.9')
+    # marker size is the square of the side in points
+    size = (res / 2.54 * 72) ** 2
+    points = axes.scatter(lons, lats, c=losses / 1000, s=size, marker='s',
+        cmap=cmap, norm=norm, linewidths=0)
+    axes.set_xlim(lons.min() - 0.25, lons.max() + 0.25)
+    axes.set_ylim(lats.min() - 0.25, lats.max() + 0.25)
+    axes.grid(True)
+    figure.colorbar(points, orientation='horizontal', extend='both',
+        spacing='uniform', format='%.0e')
+
+    for file_format in formats:
+        map_file_name = os.path.join(output_dir, 'map.%s' % file_format)
+        figure.savefig(map_file_name, dpi=150, bbox_inches='tight')
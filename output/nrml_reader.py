@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+"""
+Streaming readers for the NRML result files handled by the output
+converters: hazard maps, hazard curves, loss maps and loss curves.
+Supports NRML format 0.3, and 0.4 for loss maps.
+Every reader yields one compact record per node, with coordinates and
+curves already parsed, and frees the parsed elements as it goes, so
+memory does not grow with the size of the file.
+Asset taxonomies can be read from NRML 0.3 exposure files.
+Required libraries are:
+- lxml
+- numpy
+"""
+
+from collections import namedtuple
+from lxml import etree
+import numpy
+
+xmlNRML = '{http://openquake.org/xmlns/nrml/0.3}'
+xmlNRML04 = '{http://openquake.org/xmlns/nrml/0.4}'
+xmlGML = '{http://www.opengis.net/gml}'
+
+POS = '%spos' % xmlGML
+IML = '%sIML' % xmlNRML
+POE = '%spoE' % xmlNRML
+HM_NODE = '%sHMNode' % xmlNRML
+HC_NODE = '%sHCNode' % xmlNRML
+LM_NODE = '%sLMNode' % xmlNRML
+LM_VALUE = '%svalue' % xmlNRML
+LM_MEAN = '%smean' % xmlNRML
+ASSET = '%sasset' % xmlNRML
+LOSS_CURVE = '%slossCurve' % xmlNRML
+LOSS_RATIO_CURVE = '%slossRatioCurve' % xmlNRML
+LOSS = '%sloss' % xmlNRML
+LOSS_RATIO = '%slossRatio' % xmlNRML
+ASSET_DEFINITION = '%sassetDefinition' % xmlNRML
+TAXONOMY = '%staxonomy' % xmlNRML
+NODE_04 = '%snode' % xmlNRML04
+LOSS_04 = '%sloss' % xmlNRML04
+
+HazardMapNode = namedtuple('HazardMapNode', 'lon, lat, iml')
+HazardCurveNode = namedtuple('HazardCurveNode', 'lon, lat, imls, poes')
+LossMapNode = namedtuple('LossMapNode', 'lon, lat, loss')
+LossCurveAsset = namedtuple('LossCurveAsset',
+	'asset_id, x_label, lon, lat, loss, poe')
+
+def iterparse_elements(source, tags):
+	"""
+	Yield the elements with the given tags as soon as they are parsed.
+	Once the caller is done with an element, the element and all
+	its preceding siblings are removed from the tree.
+	"""
+	for _, element in etree.iterparse(source, tag=tags):
+		yield element
+		element.clear()
+		parent = element.getparent()
+		if parent is not None:
+			while element.getprevious() is not None:
+				del parent[0]
+
+def parse_floats(text):
+	"""
+	Parse a whitespace separated list of values to a float array.
+	"""
+	return numpy.fromstring(text, dtype=float, sep=' ')
+
+def parse_pos(element):
+	"""
+	Return longitude and latitude of the first gml:pos
+	contained in element.
+	"""
+	lon, lat = next(element.iter(POS)).text.split()[:2]
+	return float(lon), float(lat)
+
+def read_hazard_map(hazard_map_file):
+	"""
+	Yield a HazardMapNode for each HMNode element.
+	"""
+	for element in iterparse_elements(hazard_map_file, HM_NODE):
+		lon, lat = parse_pos(element)
+		iml = float(next(element.iter(IML)).text)
+		yield HazardMapNode(lon, lat, iml)
+
+def read_hazard_curves(hazard_curves_file):
+	"""
+	Yield a HazardCurveNode for each HCNode element, with the
+	intensity measure levels of the enclosing curve field.
+	"""
+	imls = None
+	for element in iterparse_elements(hazard_curves_file, (IML, HC_NODE)):
+		if element.tag == IML:
+			imls = parse_floats(element.text)
+		else:
+			lon, lat = parse_pos(element)
+			poes = parse_floats(next(element.iter(POE)).text)
+			yield HazardCurveNode(lon, lat, imls, poes)
+
+def read_loss_map(loss_map_file):
+	"""
+	Yield a LossMapNode for each LMNode (NRML 0.3) or node (NRML 0.4)
+	element. The loss is the sum of the losses (value, or mean)
+	of all the assets at the node.
+	"""
+	for element in iterparse_elements(loss_map_file, (LM_NODE, NODE_04)):
+		lon, lat = parse_pos(element)
+		loss = 0.0
+		if element.tag == NODE_04:
+			for child in element.iter(LOSS_04):
+				loss += float(child.get('mean'))
+		else:
+			for child in element.iter(LM_VALUE, LM_MEAN):
+				loss += float(child.text)
+		yield LossMapNode(lon, lat, loss)
+
+def read_loss_curves(loss_curves_file):
+	"""
+	Yield a LossCurveAsset for each asset element. When an asset
+	has more than one curve, the last one is returned.
+	"""
+	for element in iterparse_elements(loss_curves_file, ASSET):
+		lon, lat = parse_pos(element)
+		for curve in element.iter(LOSS_CURVE, LOSS_RATIO_CURVE):
+			if curve.tag == LOSS_CURVE:
+				x_label = 'loss'
+				loss = parse_floats(curve.findtext(LOSS))
+			else:
+				x_label = 'loss ratio'
+				loss = parse_floats(curve.findtext(LOSS_RATIO))
+			poe = parse_floats(curve.findtext(POE))
+		yield LossCurveAsset(element.get('%sid' % xmlGML),
+			x_label, lon, lat, loss, poe)
+
+def read_exposure_taxonomies(exposure_file):
+	"""
+	Yield asset ID and taxonomy of each assetDefinition element
+	of an exposure file.
+	"""
+	for element in iterparse_elements(exposure_file, ASSET_DEFINITION):
+		yield element.get('%sid' % xmlGML), element.findtext(TAXONOMY)
@@ -2,15 +2,32 @@
 
 """
 Plot disaggregation results stored in a hdf5 file as produced by OpenQuake using GMT (http://gmt.soest.hawaii.edu/).
+Supported pmfs missing from the file are computed, when possible, by summing
+a larger pmf available in the file (eg. MagPMF from MagDistEpsPMF).
 Requires argparse, h5py, numpy, and GMT.
 GMT must be defined in the PATH.
 
 Example:
 
 ./plotDisaggregation.py --config_file=config.gem --results_file=results.h5
+
+Results of many sites can be plotted at once, in parallel, with --batch.
+Each file, and each group of a file, containing disaggregation results is
+plotted in its own temporary folder, and the plots are saved with a prefix
+made of file and group name. A manifest records the PMFs plotted for each
+job and how long it took:
+
+./plotDisaggregation.py --config_file=config.gem --batch='results/*.h5' --processes=8
 """
 
+import os
 import sys
+import csv
+import glob
+import time
+import shutil
+import tempfile
+import multiprocessing
 import ConfigParser
 import argparse
 import h5py
@@ -26,6 +43,19 @@ TECT_REGS = ['ACTIVE', 'STABLE', 'SUB_INTER', 'SUB_INTRA', 'VOLCANIC']
 # list of pmfs that can be plotted
 SUPPORTED_PMFS = ['TRTPMF','MagDistEpsPMF','DistPMF','MagPMF','MagDistPMF','LatLonPMF']
 
+# axes of the pmfs, used to compute the supported pmfs
+# missing from a results file from the ones available
+PMF_AXES = {'TRTPMF':('trt',),
+	'MagPMF':('mag',),
+	'DistPMF':('dist',),
+	'MagDistPMF':('mag','dist'),
+	'MagDistEpsPMF':('mag','dist','eps'),
+	'LatLonPMF':('lat','lon'),
+	'LatLonMagDistEpsTRTPMF':('lat','lon','mag','dist','eps','trt')}
+
+# maximum number of values read at once from a hdf5 dataset
+CHUNK_SIZE = 2 ** 22
+
 def set_up_arg_parser():
 	"""
 	Set up command line parser.
@@ -37,6 +67,13 @@ def set_up_arg_parser():
 	parser.add_argument('--results_file',help='path to hdf5 file containing disaggregation results')
 	parser.add_argument('--xy_size',help='plot size along x and y (in cm)',default=15)
 	parser.add_argument('--z_size',help='plot size along z (in cm)',default=10)
+	parser.add_argument('--batch',help='plot the results of all the hdf5 files matching a glob pattern',
+		default=None)
+	parser.add_argument('--processes',help='number of worker processes used in batch mode',
+		type=int,default=multiprocessing.cpu_count())
+	parser.add_argument('--output_dir',help='folder where plots are saved in batch mode',default='.')
+	parser.add_argument('--manifest_file',help='path to the manifest written in batch mode',
+		default='disaggregation_manifest.csv')
 	return parser
 	
 def get_bin_limits(file_name):
@@ -103,6 +140,64 @@ def create_legend_file(dim,file_name,header):
 	
 	return hight,width
 
+def get_bin_centers(edges):
+	"""
+	Return bin centers from bin edges.
+	"""
+	edges = numpy.asarray(edges,dtype=float)
+	return (edges[:-1] + edges[1:]) / 2
+
+def get_bars(pmf,x_edges,y_edges):
+	"""
+	Return x, y, top, base and color index of the bars of a 2D pmf
+	(x along the first axis, y along the second), or of a 3D pmf with
+	the bars of each x-y bin stacked from the smallest to the largest
+	value along the third axis and colored by their index along it.
+	Bars are sorted from back to front, as they must be drawn.
+	"""
+	pmf = numpy.asarray(pmf,dtype=float)
+	if pmf.ndim == 2:
+		pmf = pmf[:,:,numpy.newaxis]
+	n_z = pmf.shape[2]
+
+	# values of each x-y bin sorted from the smallest to the largest,
+	# each bar starting where the previous one ends
+	colors = numpy.argsort(pmf,axis=2,kind='mergesort')
+	heights = numpy.take_along_axis(pmf,colors,axis=2)
+	tops = numpy.cumsum(heights,axis=2)
+	bases = tops - heights
+
+	x,y = numpy.meshgrid(get_bin_centers(x_edges),get_bin_centers(y_edges),indexing='ij')
+	x = numpy.repeat(x[:,:,numpy.newaxis],n_z,axis=2)
+	y = numpy.repeat(y[:,:,numpy.newaxis],n_z,axis=2)
+
+	# draw from the last x-y bin to the first, bottom bar first
+	back_to_front = (slice(None,None,-1),slice(None,None,-1))
+	return [a[back_to_front].ravel() for a in (x,y,tops,bases,colors)]
+
+def create_bars_file(x,y,top,base,file_name,colors=None):
+	"""
+	Write bars to ASCII file for GMT psxyz. Each record contains x, y,
+	top and base of one bar. If colors are given, the file is a multiple
+	segment file, with one segment for each run of bars with the same color.
+	"""
+	if len(x) != len(y) or len(x) != len(top) or len(x) != len(base):
+		raise ValueError('bars data are not consistent')
+
+	bars_file = open(file_name,'w')
+	if colors is None:
+		starts = numpy.array([0,len(x)])
+	else:
+		# first bar of each segment
+		starts = numpy.flatnonzero(numpy.diff(colors)) + 1
+		starts = numpy.concatenate(([0],starts,[len(x)]))
+	for start,end in zip(starts[:-1],starts[1:]):
+		if colors is not None:
+			bars_file.write('> -G%s\n' % COLORS[colors[start]])
+		numpy.savetxt(bars_file,numpy.column_stack((x[start:end],y[start:end],
+			top[start:end],base[start:end])),fmt='%s')
+	bars_file.close()
+
 def plot_lat_lon_pmf(pmf,lat,lon,args):
 	"""
 	Plot latitude longitude PMF
@@ -113,30 +208,19 @@ def plot_lat_lon_pmf(pmf,lat,lon,args):
 		(0.5,0.5,0.1,"Longitude-Latitude PMF")
 
 	call(["gmtset",'PLOT_DEGREE_FORMAT','ddd:mmF'])
-	
-	# plot bars one by one
+
+	# plot all bars at once, x is longitude
+	x,y,top,base,_ = get_bars(numpy.transpose(pmf),lon,lat)
+	create_bars_file(x,y,top,base,'hist.dat')
+
 	plot_file = open("lat_lon_pmf.ps",'w')
 	call(["pscoast",region,projection,annotation,'-Z0','-JZ8c','-E200/30',
 		'-Gblack','-K'],stdout=plot_file)
-	for i in range(len(lat) - 2,-1,-1):
-		for j in range(len(lon) - 2,-1,-1):
-
-			x = [(lon[j] + lon[j+1]) / 2]
-			y = [(lat[i] + lat[i+1]) / 2]
-			z = [pmf[i,j]]
-
-			create_xyz_file(x,y,z,'hist.dat')
-
-			if i == len(lon) - 2 and j==len(lat) - 2:
-				call(["psxyz","hist.dat",region,projection,
-						'-JZ8c','-E200/30','-So0.5b','-Wthinnest',
-						'-Ggray','-K','-O'],stdout=plot_file)
-			else:
-				call(["psxyz","hist.dat",region,projection,
-						'-JZ8c','-E200/30','-So0.5b','-Wthinnest',
-						'-Ggray','-O','-K'],stdout=plot_file)
-
-			call(["rm","hist.dat"])
+	call(["psxyz","hist.dat",region,projection,
+			'-JZ8c','-E200/30','-So0.5b','-Wthinnest',
+			'-Ggray','-O'],stdout=plot_file)
+	plot_file.close()
+	call(["rm","hist.dat"])
 
 def plot_mag_dist_pmf(pmf,mag,dist,args):
 	"""
@@ -146,73 +230,43 @@ def plot_mag_dist_pmf(pmf,mag,dist,args):
 	projection = "-JX%sc/%sc" % (args.xy_size,args.xy_size)
 	annotation = '-B:Magnitude (Mw):%s/:Distance (km):%s/%s:Probability::.%s:WeSnZ' % \
 		(0.5,5.0,0.1,"Magnitude-Distance PMF")
-	
-	# plot bars one by one
-	plot_file = open("mag_dist_pmf.ps",'w')
-	for i in range(len(mag) - 2,-1,-1):
-		for j in range(len(dist) - 2,-1,-1):
-
-			x = [(mag[i] + mag[i+1]) / 2]
-			y = [(dist[j] + dist[j+1]) / 2]
-			z = [pmf[i,j]]
 
-			create_xyz_file(x,y,z,'hist.dat')
+	# plot all bars at once
+	x,y,top,base,_ = get_bars(pmf,mag,dist)
+	create_bars_file(x,y,top,base,'hist.dat')
 
-			if i == len(mag) - 2 and j==len(dist) - 2:
-				call(["psxyz","hist.dat",region,projection,
-						'-JZ8c',annotation,'-E200/30','-So0.5','-Wthinnest','-Ggray','-K'],stdout=plot_file)
-			else:
-				call(["psxyz","hist.dat",region,projection,
-						'-JZ8c','-E200/30','-So0.5b','-Wthinnest','-Ggray','-O','-K'],stdout=plot_file)
-
-			call(["rm","hist.dat"])
+	plot_file = open("mag_dist_pmf.ps",'w')
+	call(["psxyz","hist.dat",region,projection,
+			'-JZ8c',annotation,'-E200/30','-So0.5b','-Wthinnest','-Ggray'],stdout=plot_file)
 	plot_file.close()
-	
+	call(["rm","hist.dat"])
+
 def plot_mag_dist_eps_pmf(pmf,mag,dist,eps,args):
 	"""
 	Plot magnitude-distance-epsilon pmf.
 	"""
-	region = "-R%s/%s/%s/%s/%s/%s" % (mag[0], mag[-1],dist[0], dist[-1],0.0,numpy.max(pmf))
+	# bars of each magnitude-distance bin are stacked
+	pmf = numpy.asarray(pmf,dtype=float)
+	region = "-R%s/%s/%s/%s/%s/%s" % (mag[0], mag[-1],dist[0], dist[-1],0.0,numpy.max(pmf.sum(axis=2)))
 	projection = "-JX%sc/%sc" % (args.xy_size,args.xy_size)
 	annotation = '-B:Magnitude (Mw):%s/:Distance (km):%s/%s:Probability::.%s:WeSnZ' % \
 	 (0.5,5.0,0.02,"Magnitude-Distance-Epsilon PMF")
-	
-	# plot bars one by one
+
+	# plot all bars at once, colored by epsilon bin
+	x,y,top,base,colors = get_bars(pmf,mag,dist)
+	create_bars_file(x,y,top,base,'hist.dat',colors)
+
 	plot_file = open("mag_dist_eps_pmf.ps",'w')
-	for i in range(len(mag) - 2,-1,-1):
-		for j in range(len(dist) - 2,-1,-1):
-			
-			# sort values from minimum to maximum
-			values = numpy.sort(pmf[i,j,:])
-			for k,v in enumerate(values):
-				
-				color_index = numpy.where(pmf[i,j,:]==v)
-				color = COLORS[color_index[0][0]]
-				
-				x = [(mag[i] + mag[i+1]) / 2]
-				y = [(dist[j] + dist[j+1]) / 2]
-				if k == 0:
-					base_hight = 0.0
-				else:
-					base_hight = values[k-1]
-				z = [v]
-				create_xyz_file(x,y,z,'hist.dat')
-				
-				if i == len(mag) - 2 and j==len(dist) - 2 and k == 0:
-					call(["psxyz","hist.dat",region,projection,'-JZ8c',
-						annotation,'-E200/30','-So0.5','-Wthinnest','-G'+color,'-K'],stdout=plot_file)
-				else:
-					call(["psxyz","hist.dat",region,projection,'-JZ8c',
-						'-E200/30','-So0.5b'+str(base_hight),'-Wthinnest','-G'+color,
-						'-O','-K'],stdout=plot_file)
-				
-				call(["rm","hist.dat"])
-				
+	call(["psxyz","hist.dat",region,projection,'-JZ8c',
+		annotation,'-E200/30','-So0.5b','-Wthinnest','-M','-K'],stdout=plot_file)
+	call(["rm","hist.dat"])
+
 	# plot legend
 	hight,width = create_legend_file(eps,"legend.dat","Epsilon")
 	legend_postion = "-Dx%sc/%sc/%sc/%sc/BL" % \
 					(float(args.xy_size) + width / 2, float(args.z_size) - hight / 2, width, hight)
 	call(["pslegend","legend.dat","-R","-J",legend_postion,"-O"],stdout=plot_file)
+	plot_file.close()
 	call(["rm","legend.dat"])
 	
 def plot_trt_pmf(pmf,args):
@@ -272,55 +326,249 @@ def plot_mag_pmf(pmf,mags,args):
 	call(["psxy","hist.dat",region,projection,annotation,"-Ggray","-Xc","-Yc","-Sb0.5"],stdout=plot_file)
 	call(["rm","hist.dat"])
 
+def iter_slabs(dataset):
+	"""
+	Yield slices of the first axis of a hdf5 dataset, each one
+	covering at most CHUNK_SIZE values (and at least one row).
+	"""
+	row_size = max(dataset.size // max(dataset.shape[0],1),1)
+	rows = max(CHUNK_SIZE // row_size,1)
+	for start in xrange(0,dataset.shape[0],rows):
+		yield slice(start,min(start + rows,dataset.shape[0]))
+
+def read_pmf(dataset):
+	"""
+	Read a pmf from a hdf5 dataset into an array,
+	in slabs of rows for large datasets.
+	"""
+	pmf = numpy.empty(dataset.shape,dtype=float)
+	if dataset.size <= CHUNK_SIZE:
+		pmf[...] = dataset[...]
+	else:
+		for slab in iter_slabs(dataset):
+			pmf[slab] = dataset[slab]
+	return pmf
+
+def compute_marginal(dataset,axes,marginal_axes):
+	"""
+	Compute a marginal pmf, by summing a pmf with the given axes over the
+	axes not in marginal_axes. The pmf is read in slabs of rows.
+	"""
+	sum_axes = tuple(i for i,axis in enumerate(axes) if axis not in marginal_axes)
+	if axes[0] in marginal_axes:
+		marginal = numpy.empty(tuple(n for i,n in enumerate(dataset.shape)
+			if i not in sum_axes))
+		for slab in iter_slabs(dataset):
+			marginal[slab] = numpy.sum(dataset[slab],axis=sum_axes)
+	else:
+		marginal = 0.0
+		for slab in iter_slabs(dataset):
+			marginal = marginal + numpy.sum(dataset[slab],axis=sum_axes)
+	return marginal
+
+def get_marginal_source(pmf_key,available):
+	"""
+	Return the smallest of the available pmfs from which
+	pmf_key can be computed, or None.
+	"""
+	axes = PMF_AXES[pmf_key]
+	sources = [key for key in available if key in PMF_AXES and key != pmf_key and
+		[axis for axis in PMF_AXES[key] if axis in axes] == list(axes)]
+	if sources:
+		return min(sources,key=lambda key: available[key].size)
+	return None
+
+def get_pmfs(diss_data):
+	"""
+	Return a list of (name, array) with the supported pmfs of a hdf5 file
+	or group, in file order, followed by the supported pmfs missing from
+	the file that can be computed from the available ones.
+	"""
+	pmfs = []
+	for pmf_key in diss_data.keys():
+		if pmf_key in SUPPORTED_PMFS:
+			pmfs.append((pmf_key,read_pmf(diss_data[pmf_key])))
+
+	for pmf_key in SUPPORTED_PMFS:
+		if pmf_key in diss_data:
+			continue
+		source = get_marginal_source(pmf_key,diss_data)
+		if source is not None:
+			print 'computing %s from %s...' % (pmf_key,source)
+			pmfs.append((pmf_key,compute_marginal(diss_data[source],
+				PMF_AXES[source],PMF_AXES[pmf_key])))
+	return pmfs
+
+def plot_pmfs(diss_data,bin_limits,args):
+	"""
+	Plot the supported pmfs of a hdf5 file or group
+	to the current folder. Return the plotted pmfs.
+	"""
+	plotted = []
+
+	# subgroups (e.g. one per poe) are not pmfs, they are skipped silently
+	for pmf_key in diss_data.keys():
+		if pmf_key not in PMF_AXES and \
+				not isinstance(diss_data[pmf_key],h5py.Group):
+			print '%s not supported for plotting, sorry.' % (pmf_key)
+
+	# loop over disaggregation results and plot the
+	# pmfs that are currently supported
+	for pmf_key,pmf in get_pmfs(diss_data):
+		print 'plotting %s...'% (pmf_key)
+		
+		if pmf_key == 'MagDistEpsPMF':
+			plot_mag_dist_eps_pmf(pmf,\
+				numpy.array(bin_limits['mags'],dtype=float),\
+				numpy.array(bin_limits['dists'],dtype=float),\
+				numpy.array(bin_limits['eps'],dtype=float), \
+				args)
+									
+		if pmf_key == 'TRTPMF':
+			plot_trt_pmf(pmf,args)
+
+		if pmf_key == 'DistPMF':
+			plot_dist_pmf(pmf,numpy.array(bin_limits['dists'],dtype=float),args)
+
+		if pmf_key == 'MagPMF':
+			plot_mag_pmf(pmf,numpy.array(bin_limits['mags'],dtype=float),args)
+
+		if pmf_key == 'MagDistPMF':
+			plot_mag_dist_pmf(pmf,
+						numpy.array(bin_limits['mags'],dtype=float),
+						numpy.array(bin_limits['dists'],dtype=float),args)
+
+		if pmf_key == 'LatLonPMF':
+			plot_lat_lon_pmf(pmf,
+						numpy.array(bin_limits['lats'],dtype=float),
+						numpy.array(bin_limits['lons'],dtype=float),args)
+
+		plotted.append(pmf_key)
+		print 'done.'
+
+	return plotted
+
+def get_batch_jobs(pattern):
+	"""
+	Return (results file, group name) of each hdf5 file matching a glob
+	pattern, and of each group in them, containing supported pmfs.
+	The root group of a file is named '/'.
+	"""
+	jobs = []
+	for results_file in sorted(glob.glob(pattern)):
+		with h5py.File(results_file,'r') as diss_data:
+			groups = [diss_data]
+			diss_data.visititems(lambda name,obj: groups.append(obj)
+				if isinstance(obj,h5py.Group) else None)
+			for group in groups:
+				if any(key in PMF_AXES for key in group.keys()):
+					jobs.append((results_file,group.name))
+	return jobs
+
+def get_job_prefixes(jobs):
+	"""
+	Return the prefix of the plots of each job, made of the path of
+	the results file, relative to the folder common to all the files,
+	and of the group name. Prefixes still clashing get a counter.
+	"""
+	dirs = [os.path.dirname(os.path.abspath(f)).split(os.sep) for f,_ in jobs]
+	common = 0
+	while dirs and all(len(d) > common and d[common] == dirs[0][common] for d in dirs):
+		common += 1
+
+	prefixes = []
+	counts = {}
+	for (results_file,group_name),d in zip(jobs,dirs):
+		name = os.path.splitext(os.path.basename(results_file))[0]
+		prefix = '_'.join(d[common:] + [name])
+		if group_name != '/':
+			prefix += group_name.replace('/','_')
+		counts[prefix] = counts.get(prefix,0) + 1
+		if counts[prefix] > 1:
+			prefix += '_%d' % counts[prefix]
+		prefixes.append(prefix)
+	return prefixes
+
+def plot_job(job):
+	"""
+	Plot the pmfs of a hdf5 group in a temporary folder, and move the
+	plots to the output folder with the job prefix. Return the manifest
+	record of the job: file, group, prefix, plotted pmfs, seconds, error.
+	"""
+	results_file,group_name,prefix,bin_limits,args = job
+	start = time.time()
+	plotted = []
+	error = None
+
+	cwd = os.getcwd()
+	tmp_dir = tempfile.mkdtemp(prefix='disaggregation_')
+	try:
+		with h5py.File(os.path.join(cwd,results_file),'r') as diss_data:
+			os.chdir(tmp_dir)
+			plotted = plot_pmfs(diss_data[group_name],bin_limits,args)
+		for ps_file in glob.glob('*.ps'):
+			shutil.move(ps_file,os.path.join(cwd,args.output_dir,'%s_%s' % (prefix,ps_file)))
+	except Exception, e:
+		error = '%s: %s' % (e.__class__.__name__,e)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tmp_dir,ignore_errors=True)
+
+	return results_file,group_name,prefix,plotted,time.time() - start,error
+
+def plot_batch(jobs,bin_limits,args):
+	"""
+	Plot jobs in parallel, write the manifest and print a summary.
+	Return the failed jobs.
+	"""
+	if not os.path.isdir(args.output_dir):
+		os.makedirs(args.output_dir)
+
+	start = time.time()
+	pool = multiprocessing.Pool(args.processes)
+	records = pool.map(plot_job,[(f,g,prefix,bin_limits,args)
+		for (f,g),prefix in zip(jobs,get_job_prefixes(jobs))])
+	pool.close()
+	pool.join()
+
+	with open(args.manifest_file,'wb') as f:
+		writer = csv.writer(f)
+		writer.writerow(['results_file','group','prefix','plotted_pmfs','seconds','error'])
+		for results_file,group_name,prefix,plotted,seconds,error in records:
+			writer.writerow([results_file,group_name,prefix,' '.join(plotted),
+				'%.2f' % seconds,error or ''])
+
+	failures = [r for r in records if r[-1] is not None]
+	print 'Plotted %d of %d jobs in %.1f s using %d processes, manifest saved to %s' % \
+		(len(records) - len(failures),len(records),time.time() - start,
+		args.processes,args.manifest_file)
+	for results_file,group_name,_,_,_,error in failures:
+		print 'FAILED %s %s: %s' % (results_file,group_name,error)
+
+	return failures
+
 def main(argv):
 	
 	parser = set_up_arg_parser()
 	args = parser.parse_args()
 	
-	if args.config_file and args.results_file:
+	if args.config_file and args.batch:
+
+		jobs = get_batch_jobs(args.batch)
+		if not jobs:
+			print 'No disaggregation pmfs to plot'
+			sys.exit(1)
+		bin_limits = get_bin_limits(args.config_file)
+		failures = plot_batch(jobs,bin_limits,args)
+		if failures:
+			sys.exit(1)
+
+	elif args.config_file and args.results_file:
 		
 		# extract bin limits and disaggregation results
 		bin_limits = get_bin_limits(args.config_file)
 		diss_data = h5py.File(args.results_file,'r')
-		
-		# loop over disaggregation results and plot the
-		# pmfs that are currently supported
-		pmfs =  diss_data.keys()
-		for pmf_key in pmfs:
-			
-			if pmf_key in SUPPORTED_PMFS:
-				print 'plotting %s...'% (pmf_key)
-				
-				if pmf_key == 'MagDistEpsPMF':
-					plot_mag_dist_eps_pmf(diss_data.get(pmf_key),\
-						numpy.array(bin_limits['mags'],dtype=float),\
-						numpy.array(bin_limits['dists'],dtype=float),\
-						numpy.array(bin_limits['eps'],dtype=float), \
-						args)
-											
-				if pmf_key == 'TRTPMF':
-					plot_trt_pmf(diss_data.get(pmf_key),args)
-
-				if pmf_key == 'DistPMF':
-					plot_dist_pmf(diss_data.get(pmf_key),numpy.array(bin_limits['dists'],dtype=float),args)
-
-				if pmf_key == 'MagPMF':
-					plot_mag_pmf(diss_data.get(pmf_key),numpy.array(bin_limits['mags'],dtype=float),args)
-
-				if pmf_key == 'MagDistPMF':
-					plot_mag_dist_pmf(diss_data.get(pmf_key),
-								numpy.array(bin_limits['mags'],dtype=float),
-								numpy.array(bin_limits['dists'],dtype=float),args)
-
-				if pmf_key == 'LatLonPMF':
-					plot_lat_lon_pmf(diss_data.get(pmf_key),
-								numpy.array(bin_limits['lats'],dtype=float),
-								numpy.array(bin_limits['lons'],dtype=float),args)
-
-				print 'done.'
-			else:
-				print '%s not supported for plotting, sorry.' % (pmf_key)
-				continue
+		plot_pmfs(diss_data,bin_limits,args)
 	else:
 		parser.print_help()
 		
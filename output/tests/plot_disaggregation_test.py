@@ -0,0 +1,53 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# NRML is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# NRML is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with NRML.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os
+import shutil
+import tempfile
+import h5py
+import numpy
+
+from plotDisaggregation import get_batch_jobs, get_job_prefixes
+
+
+class ABatchOfDisaggregationResultsShould(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for site in ['s1', 's2']:
+            os.mkdir(os.path.join(self.tmp_dir, site))
+            with h5py.File(os.path.join(self.tmp_dir, site, 'r.h5'),
+                           'w') as results:
+                results['MagPMF'] = numpy.ones(3) / 3
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_give_unique_prefixes_to_files_with_the_same_name(self):
+        jobs = get_batch_jobs(os.path.join(self.tmp_dir, 's*', 'r.h5'))
+
+        self.assertEqual(2, len(jobs))
+        self.assertEqual(['s1_r', 's2_r'], get_job_prefixes(jobs))
+
+    def test_name_plots_of_a_single_file_after_the_file(self):
+        jobs = get_batch_jobs(os.path.join(self.tmp_dir, 's1', 'r.h5'))
+
+        self.assertEqual(['r'], get_job_prefixes(jobs))
+
+    def test_give_unique_prefixes_to_clashing_group_names(self):
+        jobs = [('r.h5', '/a/b'), ('r.h5', '/a_b')]
+
+        self.assertEqual(['r_a_b', 'r_a_b_2'], get_job_prefixes(jobs))